@@ -1,7 +1,7 @@
 #Python implementation of bwtav.pro IDL script by Andrea Biviano
 
 import numpy as np
-from scipy.stats import t, chi2
+from functions.stats import QUANTILES_68
 
 def iter_bwt(x, x_median, x_mad):
     
@@ -28,9 +28,8 @@ def bwt_ave(x):
         bwt_ave, bwt_std = iter_bwt(x, x_median, x_mad)
         x_median = bwt_ave
         
-    chi2_68_left = chi2.ppf(0.32 / 2.0, len(x) - 1)
-    chi2_68_right = chi2.isf(0.32 / 2.0, len(x) - 1)
-    t_68 = t.isf(0.32 / 2.0, long(0.7 * (len(x) - 1)))
+    chi2_68_left, chi2_68_right = QUANTILES_68.get(len(x) - 1)[:2]
+    t_68 = QUANTILES_68.get(long(0.7 * (len(x) - 1)))[2]
         
     bwt_ave_low = bwt_ave + t_68 * bwt_std / np.sqrt(len(x))
     bwt_ave_up = bwt_ave - t_68 * bwt_std / np.sqrt(len(x))
@@ -38,3 +37,79 @@ def bwt_ave(x):
     bwt_std_up = (np.sqrt((len(x) - 1) / chi2_68_right) - 1.) * bwt_std
         
     return (bwt_ave, bwt_ave_low, bwt_ave_up), (bwt_std, bwt_std_low, bwt_std_up)
+
+# Sums over the rows of a 2-D array, or over the groups of a ragged
+# array given the row of every value.
+def row_sum(x, row = None, n_rows = None):
+
+    if row is None:
+        return np.sum(x, axis = 1)
+    else:
+        return np.bincount(row, x, n_rows)
+
+def row_median(x, offsets = None, row = None):
+
+    if offsets is None:
+        return np.median(x, axis = 1)
+
+    n = np.diff(offsets)
+    x_sort = x[np.lexsort((x, row))]
+
+    return 0.5 * (x_sort[offsets[:-1] + (n - 1) // 2] + x_sort[offsets[:-1] + n // 2])
+
+def iter_bwt_batch(x, x_median, x_mad, n, row = None):
+
+    if row is None:
+        x_diff = x - x_median[:, None]
+        x_mad = x_mad[:, None]
+    else:
+        x_diff = x - x_median[row]
+        x_mad = x_mad[row]
+    u1 = x_diff / (6.0 * x_mad)
+    u2 = x_diff / (9.0 * x_mad)
+
+    st1 = row_sum(((x_diff ** 2) * (1.0 - (u2 ** 2)) ** 4) * (np.abs(u2) < 1.0), row, len(n))
+    st2 = row_sum((1.0 - (u2 ** 2)) * (1.0 - (5.0 * u2 ** 2)) * (np.abs(u2) < 1.0), row, len(n))
+    st3 = row_sum((x_diff * (1.0 - u1 * u1) ** 2) * (np.abs(u1) < 1.0), row, len(n))
+    st4 = row_sum(((1.0 - u1 ** 2) ** 2) * (abs(u1) < 1.0), row, len(n))
+
+    bwt_ave = x_median + st3 / st4
+    bwt_std = n * np.sqrt(st1 / (n - 1.0)) / np.abs(st2)
+
+    return bwt_ave, bwt_std
+
+# Same as bwt_ave for each row of a 2-D array, or for each group of a
+# ragged array given as the concatenated values and the offsets of the
+# groups (len(offsets) = number of groups + 1). The loop in bwt_ave
+# compares the estimate with the median it has just replaced, so it
+# makes a single update of the median, and so does this function for
+# all rows together.
+def bwt_ave_batch(x, offsets = None):
+
+    x = np.asarray(x, dtype = 'float64')
+
+    if offsets is None:
+        row = None
+        n = np.ones(len(x)) * x.shape[1]
+    else:
+        offsets = np.asarray(offsets)
+        n = np.diff(offsets).astype('float64')
+        row = np.repeat(np.arange(len(n)), np.diff(offsets))
+
+    x_median = row_median(x, offsets, row)
+    if row is None:
+        x_mad = row_median(np.abs(x - x_median[:, None]))
+    else:
+        x_mad = row_median(np.abs(x - x_median[row]), offsets, row)
+
+    bwt_ave, bwt_std = iter_bwt_batch(x, x_median, x_mad, n, row)
+
+    chi2_68_left, chi2_68_right = QUANTILES_68.get(n - 1)[:2]
+    t_68 = QUANTILES_68.get(np.floor(0.7 * (n - 1)))[2]
+
+    bwt_ave_low = bwt_ave + t_68 * bwt_std / np.sqrt(n)
+    bwt_ave_up = bwt_ave - t_68 * bwt_std / np.sqrt(n)
+    bwt_std_low = (np.sqrt((n - 1) / chi2_68_left) - 1.) * bwt_std
+    bwt_std_up = (np.sqrt((n - 1) / chi2_68_right) - 1.) * bwt_std
+
+    return (bwt_ave, bwt_ave_low, bwt_ave_up), (bwt_std, bwt_std_low, bwt_std_up)
@@ -13,20 +13,28 @@
 #  @date 2015
 #
 
+import os
+import sys
 import numpy as np
+from copy import copy
+from itertools import islice
+from multiprocessing import Pool
 from cluster_methods import *
 from functions.interface import h_line
 
 ##
-#  Code Main.
-def main():
-
-    # Get code arguments
-    opts = cluster_opts.get_opts()
-
-    # Read input file
-    h_line()
-    data = cluster_io.read_ascii(opts)
+#  Run the centre and profile fit pipeline
+#  for one cluster.
+#
+#  @param[in] opts: List of arguments.
+#  @param[in] data: DataFrame of cluster members.
+#  @param[in] output: Option to write the log
+#  and plots.
+#
+#  @return Profile data and number of members
+#  within the cluster radius.
+#
+def run_cluster(opts, data, output = True):
 
     if not opts.radial:
 
@@ -39,7 +47,8 @@ def main():
         # Assign centre
         if len(opts.centre) == 1:
             if opts.centre[0] == 'kde':
-                centre, kde_data = cluster_centre.kde_centre(data)
+                centre, kde_data = cluster_centre.kde_centre(data, opts.kde_method,
+                                                             opts.kde_refine)
             elif opts.centre[0] == 'median':
                 centre = np.zeros(2)
         else:
@@ -74,9 +83,15 @@ def main():
 
     h_line()
 
+    if not output:
+        return p_data, sum(index)
+
     if opts.log:
         cluster_io.write_p_data(opts, p_data)
 
+    if 'chain' in p_data[4]:
+        cluster_io.write_chain(opts, p_data[4]['chain'])
+
     # Make plots
     if 'zhist' in opts.plot:
         cluster_plot.plot_zhist(opts, data)
@@ -90,5 +105,116 @@ def main():
         cluster_plot.plot_profile(opts, p_data)
     h_line()
 
+    return p_data, sum(index)
+
+##
+#  Fit one cluster of a catalogue. Errors are
+#  caught so that a failed cluster does not stop
+#  the other fits.
+#
+#  @param[in] args: Tuple of code options,
+#  cluster ID and DataFrame of cluster members.
+#
+#  @return Cluster ID, profile data (None if the
+#  fit failed), number of members within the
+#  cluster radius and error message.
+#
+def cluster_task(args):
+
+    opts, cluster_id, members = args
+
+    h_line()
+    print ' * Cluster ID = ', cluster_id, '(%i members)' % len(members)
+
+    try:
+        p_data, n_members = run_cluster(opts, members, False)
+
+    except Exception as err:
+        return cluster_id, None, len(members), '%s: %s' % (type(err).__name__, err)
+
+    return cluster_id, p_data, n_members, None
+
+##
+#  Fit clusters with a pool of processes. The
+#  tasks are sent to the pool in windows of
+#  16 clusters per process, so that a streamed
+#  catalogue is not read ahead of the fits.
+#  The fits are returned in task order.
+#
+#  @param[in] pool: Pool of processes.
+#  @param[in] tasks: Iterator of cluster tasks.
+#  @param[in] jobs: Number of processes.
+#
+#  @return Generator of cluster fits.
+#
+def pool_fits(pool, tasks, jobs):
+
+    for batch in iter(lambda: list(islice(tasks, 16 * jobs)), []):
+        for fit in pool.imap(cluster_task, batch, 4):
+            yield fit
+
+##
+#  Silence the output of a worker process.
+def quiet_worker():
+
+    sys.stdout = open(os.devnull, 'w')
+
+##
+#  Code Main.
+def main():
+
+    # Get code arguments
+    opts = cluster_opts.get_opts()
+
+    h_line()
+
+    if opts.all_ids:
+
+        # Read the whole catalogue or stream it in chunks. The cache
+        # needs the whole catalogue.
+        if opts.chunk_size and not opts.cache:
+            clusters = cluster_io.stream_clusters(opts)
+        else:
+            clusters = cluster_io.group_clusters(cluster_io.read_ascii(opts))
+
+        # Fit every cluster in the catalogue. Each cluster gets its
+        # own copy of the options as the pipeline updates them.
+        # Worker processes can not start their own pool, so in
+        # parallel the bootstrap of each cluster is serial.
+        task_opts = copy(opts)
+        if opts.jobs > 1:
+            task_opts.jobs = 1
+        tasks = ((copy(task_opts), cluster_id, members)
+                 for cluster_id, members in clusters)
+
+        if opts.jobs > 1:
+            pool = Pool(opts.jobs, quiet_worker)
+            fits = pool_fits(pool, tasks, opts.jobs)
+
+        else:
+            pool = None
+            fits = (cluster_task(task) for task in tasks)
+
+        results = []
+        for cluster_id, p_data, n_members, error in fits:
+            if error:
+                print ' * Cluster ID = ', cluster_id, 'FAILED:', error
+            elif opts.jobs > 1:
+                print ' * Cluster ID = ', cluster_id, '(%i members) done.' % n_members
+            results.append((cluster_id, p_data, n_members))
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        # Streamed clusters are not in ID order.
+        results.sort(key = lambda result: result[0])
+
+        h_line()
+        cluster_io.write_results(opts, results)
+
+    else:
+        run_cluster(opts, cluster_io.read_ascii(opts))
+
 if __name__ == "__main__":
     main()
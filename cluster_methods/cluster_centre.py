@@ -13,6 +13,24 @@
 import numpy as np
 import pandas as pd
 from scipy.stats import gaussian_kde
+from scipy.ndimage import maximum_filter
+from scipy.optimize import minimize
+
+##
+#  Number of KDE grid points along each axis.
+KDE_GRID = 100
+
+##
+#  Number of points along each axis and number
+#  of steps of the zoom grids of the KDE peak
+#  refinement. The window is halved at each step.
+KDE_ZOOM_GRID = 5
+KDE_ZOOM_STEPS = 4
+
+##
+#  Position tolerance of the final KDE peak
+#  optimisation [Mpc].
+KDE_XTOL = 1e-5
 
 ##
 #  Function that finds cluster
@@ -20,25 +38,158 @@ from scipy.stats import gaussian_kde
 #  kernel density estimator.
 #
 #  @param[in] data: Cluster DataFrame.
+#  @param[in] method: KDE method (direct or fft).
+#  Default (method = 'direct').
+#  @param[in] peaks: Number of grid peaks to
+#  refine (0 for the grid centre). Default
+#  (peaks = 0).
 #
-def kde_centre(data):
-    
-    kde = gaussian_kde(np.vstack([data.x, data.y]),
-                       bw_method = 'silverman')
+def kde_centre(data, method = 'direct', peaks = 0):
 
     x_limit = max(abs(data.x.min()), data.x.max())
     y_limit = max(abs(data.y.min()), data.y.max())
     
-    xedges = np.linspace(-x_limit, x_limit, 100)
-    yedges = np.linspace(-y_limit, y_limit, 100)
-    
-    xx, yy = np.meshgrid(xedges, yedges)
-    gridpoints = np.array([xx.ravel(), yy.ravel()])
+    xedges = np.linspace(-x_limit, x_limit, KDE_GRID)
+    yedges = np.linspace(-y_limit, y_limit, KDE_GRID)
+
+    kde = gaussian_kde(np.vstack([data.x, data.y]),
+                       bw_method = 'silverman')
+
+    if method == 'fft':
+        zz = binned_kde(np.array(data.x), np.array(data.y), xedges, yedges)
+        n_evals = 0
+
+    else:
+        xx, yy = np.meshgrid(xedges, yedges)
+        gridpoints = np.array([xx.ravel(), yy.ravel()])
+
+        zz = np.reshape(kde(gridpoints), xx.shape)
+        n_evals = zz.size
+
+    if peaks:
+        centre, n_zoom, precision = kde_refine(kde, xedges, yedges, zz, peaks)
+        print ' KDE centre: (%.6f, %.6f) Mpc, precision %.1e Mpc,' % \
+          (centre[0], centre[1], precision), n_evals + n_zoom, 'KDE evaluations.'
+
+    else:
+        index = np.unravel_index(zz.argmax(), zz.shape)
+        centre = (xedges[index[1]], yedges[index[0]])
 
-    zz = np.reshape(kde(gridpoints), xx.shape)
-    index = np.unravel_index(zz.argmax(), zz.shape)
-    
-    centre = (xedges[index[1]], yedges[index[0]])
     kde_data = (xedges, yedges, zz)
     
     return centre, kde_data
+
+##
+#  Function that refines the peak of a KDE. The
+#  highest local maxima of the grid are zoomed
+#  into with grids of KDE_ZOOM_GRID x
+#  KDE_ZOOM_GRID points, halving the window at
+#  each of KDE_ZOOM_STEPS steps. The best peak
+#  is then found with a Nelder-Mead search to a
+#  position tolerance of KDE_XTOL.
+#
+#  @param[in] kde: Gaussian KDE.
+#  @param[in] xedges: Grid in x.
+#  @param[in] yedges: Grid in y.
+#  @param[in] zz: KDE on the grid.
+#  @param[in] peaks: Number of grid peaks to
+#  refine.
+#
+#  @return Centre, number of KDE evaluations
+#  and precision of the centre.
+#
+def kde_refine(kde, xedges, yedges, zz, peaks):
+
+    # Highest local maxima of the grid.
+    maxima = np.flatnonzero(zz == maximum_filter(zz, size = 3, mode = 'nearest'))
+    maxima = maxima[np.argsort(zz.ravel()[maxima])[::-1][:peaks]]
+
+    width = np.array([xedges[1] - xedges[0], yedges[1] - yedges[0]])
+    steps = np.linspace(-1.0, 1.0, KDE_ZOOM_GRID)
+    offsets = np.array(np.meshgrid(steps, steps)).reshape(2, -1)
+    n_evals = 0
+
+    best = None
+    for index in maxima:
+        iy, ix = np.unravel_index(index, zz.shape)
+        centre, value = np.array([xedges[ix], yedges[iy]]), zz[iy, ix]
+        window = width.copy()
+        for step in range(KDE_ZOOM_STEPS):
+            points = centre[:, None] + window[:, None] * offsets
+            values = kde(points)
+            n_evals += values.size
+            centre, value = points[:, values.argmax()], values.max()
+            window *= 0.5
+        if best is None or value > best[1]:
+            best = (centre, value, window)
+
+    # The initial simplex spans the last zoom grid spacing.
+    centre, value, window = best
+    simplex = centre + np.array([[0.0, 0.0], [window[0], 0.0], [0.0, window[1]]])
+    res = minimize(lambda pos: -kde(pos)[0], centre, method = 'Nelder-Mead',
+                   options = {'initial_simplex': simplex, 'xatol': KDE_XTOL,
+                              'fatol': np.inf})
+    n_evals += res.nfev
+
+    if -res.fun > value:
+        centre = res.x
+    precision = np.max(np.abs(res.final_simplex[0] - res.final_simplex[0][0]))
+
+    return tuple(centre), n_evals, precision
+
+##
+#  Function that calculates a Gaussian kernel
+#  density estimate on a grid. The points are
+#  linearly binned onto the grid nodes and the
+#  counts are convolved with the kernel by FFT.
+#  The kernel covariance is the data covariance
+#  scaled by the Silverman factor, as in
+#  gaussian_kde.
+#
+#  @param[in] x: X positions.
+#  @param[in] y: Y positions.
+#  @param[in] xedges: Uniform grid in x that
+#  contains all the points.
+#  @param[in] yedges: Uniform grid in y that
+#  contains all the points.
+#
+#  @return Density on the grid with shape
+#  (len(yedges), len(xedges)).
+#
+def binned_kde(x, y, xedges, yedges):
+
+    n_x, n_y, n = len(xedges), len(yedges), len(x)
+    dx, dy = xedges[1] - xedges[0], yedges[1] - yedges[0]
+
+    # Linear binning. Each point is shared between the four
+    # surrounding nodes.
+    gx = np.clip((x - xedges[0]) / dx, 0, n_x - 1)
+    gy = np.clip((y - yedges[0]) / dy, 0, n_y - 1)
+    ix = np.minimum(gx.astype(int), n_x - 2)
+    iy = np.minimum(gy.astype(int), n_y - 2)
+    fx, fy = gx - ix, gy - iy
+
+    counts = np.zeros(n_y * n_x)
+    for sy, wy in ((0, 1.0 - fy), (1, fy)):
+        for sx, wx in ((0, 1.0 - fx), (1, fx)):
+            counts += np.bincount((iy + sy) * n_x + ix + sx, wy * wx,
+                                  minlength = n_y * n_x)
+
+    # Silverman factor (n * (d + 2) / 4) ** (-1 / (d + 4)) squared
+    # for d = 2.
+    inv_cov = np.linalg.inv(np.cov(np.vstack([x, y])) * n ** (-1.0 / 3.0))
+    norm = np.sqrt(np.linalg.det(inv_cov)) / (2.0 * np.pi * n)
+
+    # Kernel on the node offsets in FFT order. The grids are padded
+    # to twice their size so that the convolution does not wrap.
+    shape = (2 * n_y, 2 * n_x)
+    off_x = np.fft.fftfreq(shape[1], 1.0 / shape[1])[None, :] * dx
+    off_y = np.fft.fftfreq(shape[0], 1.0 / shape[0])[:, None] * dy
+    kernel = norm * np.exp(-0.5 * (inv_cov[0, 0] * off_x ** 2 +
+                                   2.0 * inv_cov[0, 1] * off_x * off_y +
+                                   inv_cov[1, 1] * off_y ** 2))
+
+    zz = np.fft.irfft2(np.fft.rfft2(counts.reshape(n_y, n_x), shape) *
+                       np.fft.rfft2(kernel), shape)
+
+    return zz[:n_y, :n_x]
@@ -11,54 +11,418 @@
 #  @date 2015
 #
 
+import os
+import json
+import struct
+import tempfile
+import cPickle as pickle
 import numpy as np
 import pandas as pd
 from time import strftime
+from resource import getrusage, RUSAGE_SELF
+
+CACHE_MAGIC = 'CLCACHE1'
+CACHE_ALIGN = 64
+SPILL_BUCKETS = 64
 
 ##
-#  Read ascii file and return pandas
-#  DataFrame of cluster members.
+#  Key of the input file for the cache. The
+#  cache is only valid for the same file size,
+#  modification time and columns.
 #
 #  @param[in] opts: List of arguments.
 #
-#  @return DataFrame of members.
+#  @return Dictionary key.
 #
-def read_ascii(opts):
+def cache_key(opts):
+
+    stat = os.stat(opts.input_file)
+
+    return {'size' : stat.st_size, 'mtime' : stat.st_mtime,
+            'cols' : [int(col) for col in opts.cols], 'radial' : bool(opts.radial)}
+
+##
+#  Write binary cache file of the input
+#  columns. The members are sorted by cluster
+#  ID and the file contains a header, an index
+#  of cluster IDs and offsets, and one block
+#  per column.
+#
+#  @param[in] opts: List of arguments.
+#  @param[in] names: Column names.
+#  @param[in] columns: List of column arrays.
+#  @param[in] cluster_ids: Cluster ID of each
+#  member (None if there is no ID column).
+#
+def write_cache(opts, names, columns, cluster_ids):
+
+    if cluster_ids is not None:
+        order = np.argsort(cluster_ids, kind = 'mergesort')
+        cluster_ids = cluster_ids[order]
+        columns = [column[order] for column in columns]
+        starts = np.flatnonzero(np.append(True, cluster_ids[1:] != cluster_ids[:-1]))
+        index_id = cluster_ids[starts]
+        index_start = np.append(starts, len(cluster_ids))
+    else:
+        index_id = np.array([], dtype = 'S1')
+        index_start = np.array([0, len(columns[0])])
+
+    arrays = [(name, np.asarray(column, dtype = 'S' if column.dtype == object
+                                else column.dtype))
+              for name, column in zip(names, columns)]
+    arrays.extend([('index_id', np.asarray(index_id, dtype = 'S')),
+                   ('index_start', np.asarray(index_start, dtype = 'int64'))])
+
+    blocks = []
+    offset = 0
+    for name, array in arrays:
+        blocks.append([name, array.dtype.str, len(array), offset])
+        offset += -(-array.nbytes // CACHE_ALIGN) * CACHE_ALIGN
+
+    header = json.dumps({'key' : cache_key(opts), 'blocks' : blocks})
+
+    # Write to a temporary file first so that concurrent processes
+    # never read a partial cache.
+    file_name = opts.input_file + '.cache'
+    temp_name = file_name + '.' + str(os.getpid())
+
+    try:
+        with open(temp_name, 'wb') as f_handle:
+            f_handle.write(CACHE_MAGIC + struct.pack('<Q', len(header)) + header)
+            data_start = -(-f_handle.tell() // CACHE_ALIGN) * CACHE_ALIGN
+            for (name, array), block in zip(arrays, blocks):
+                f_handle.seek(data_start + block[3])
+                f_handle.write(array.tostring())
+            f_handle.truncate(data_start + offset)
+        os.rename(temp_name, file_name)
+        print ' Cache written to:', file_name
+
+    except (IOError, OSError):
+        print ' Could not write cache:', file_name
+
+##
+#  Read binary cache file of the input columns
+#  with memory maps. Only the members of the
+#  requested cluster are read.
+#
+#  @param[in] opts: List of arguments.
+#
+#  @return Dictionary of column arrays or None
+#  if the cache is missing or out of date.
+#
+def read_cache(opts):
+
+    file_name = opts.input_file + '.cache'
+
+    try:
+        with open(file_name, 'rb') as f_handle:
+            if f_handle.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            size = struct.unpack('<Q', f_handle.read(8))[0]
+            header = json.loads(f_handle.read(size))
+            data_start = -(-f_handle.tell() // CACHE_ALIGN) * CACHE_ALIGN
+
+    except (IOError, ValueError, struct.error):
+        return None
+
+    if header['key'] != cache_key(opts):
+        return None
+
+    data = {}
+    for name, dtype, length, offset in header['blocks']:
+        if length:
+            data[name] = np.memmap(file_name, dtype = dtype, mode = 'r',
+                                   offset = data_start + offset, shape = (length,))
+        else:
+            data[name] = np.empty(0, dtype = dtype)
+
+    index_id, index_start = np.array(data.pop('index_id')), data.pop('index_start')
+
+    # Slice the members of one cluster from the index.
+    if opts.cluster_id:
+        match = np.flatnonzero(index_id == opts.cluster_id)
+        start, end = (index_start[match[0]], index_start[match[0] + 1]) \
+          if match.size else (0, 0)
+        data = dict((name, column[start:end]) for name, column in data.items())
+
+    elif opts.all_ids:
+        data['cluster'] = np.repeat(index_id, np.diff(index_start))
+
+    print ' Read from cache:', file_name
+
+    return data
+
+##
+#  Set the column numbers to be read from the
+#  input file.
+#
+#  @param[in] opts: List of arguments.
+#
+#  @return Column names.
+#
+def input_cols(opts):
 
     # If no column numbers have been specified in radial mode
     # then redefine the default columns to [1 2].
     if opts.radial and np.all(opts.cols == np.arange(1, 5)):
         opts.cols = np.arange(1, 3)
 
-    # If a cluster ID is specified then add the appropriate column
-    # number.
-    if opts.cluster_id:
+    # If a cluster ID is specified or all clusters are to be fitted
+    # then add the appropriate column number.
+    if opts.cluster_id or opts.all_ids:
         if opts.cluster_id_col > 0:
             opts.cols = np.hstack([opts.cluster_id_col, opts.cols])
         else:
             opts.cols = np.hstack([opts.cols, [max(opts.cols) + 1]])
 
-    # Read the only the specified columns from the input file.
-    data = np.genfromtxt(opts.input_file, unpack = True,
-                         dtype = 'S', usecols = (np.array(opts.cols) - 1))
+    return ['id', 'new_r'] if opts.radial else ['id', 'ra', 'dec', 'z']
+
+##
+#  Read the columns of the input file. The
+#  file can be gzip or bz2 compressed and is
+#  read in chunks of opts.chunk_size rows
+#  (the whole file if chunk_size is 0).
+#
+#  @param[in] opts: List of arguments.
+#  @param[in] names: Column names.
+#
+#  @return Generator of cluster IDs (None if
+#  there is no ID column) and dictionary of
+#  columns for each chunk. There are no chunks
+#  if the file has no rows.
+#
+def read_chunks(opts, names):
+
+    # Read the only the specified columns from the input file with the
+    # C parser of pandas. The member and cluster IDs are kept as strings
+    # and the coordinates are parsed directly as floats.
+    cols = np.array(opts.cols) - 1
+    n_id = 2 if (opts.cluster_id or opts.all_ids) else 1
+    dtypes = dict((col, str) for col in cols[:n_id])
+    dtypes.update((col, 'float64') for col in cols[n_id:] if col not in dtypes)
+
+    # An empty or comment-only file has no columns to parse.
+    try:
+        reader = pd.read_csv(opts.input_file, delim_whitespace = True, comment = '#',
+                             header = None, usecols = np.unique(cols), dtype = dtypes,
+                             float_precision = 'high', engine = 'c', compression = 'infer',
+                             chunksize = opts.chunk_size or None)
+    except pd.errors.EmptyDataError:
+        return
+
+    for chunk in (reader if opts.chunk_size else [reader]):
+        columns = [np.asarray(chunk[col]) for col in cols]
+        cluster_ids = columns.pop(0) if n_id == 2 else None
+        yield cluster_ids, dict(zip(names, columns))
+
+##
+#  Read ascii file and return pandas
+#  DataFrame of cluster members.
+#
+#  @param[in] opts: List of arguments.
+#
+#  @return DataFrame of members.
+#
+#  @exception ValueError if the file has no
+#  members.
+#
+def read_ascii(opts):
+
+    names = input_cols(opts)
 
-    # If a cluster ID is specified then save only the corresponding
-    # cluster members.
     if opts.cluster_id:
         print ' * Cluster ID = ', opts.cluster_id
-        data = data[1::, (data[0] == opts.cluster_id)]
 
-    print ' Successfully read:', opts.input_file, '(%i members)' % data.shape[1]
+    data = read_cache(opts) if opts.cache else None
+
+    if data is None:
+
+        # Only the members of the requested cluster are kept from each
+        # chunk, unless the whole file is needed for the cache.
+        parts = []
+        for cluster_ids, chunk in read_chunks(opts, names):
+            if opts.cluster_id and not opts.cache:
+                index = cluster_ids == opts.cluster_id
+                cluster_ids = cluster_ids[index]
+                chunk = dict((name, column[index]) for name, column in chunk.items())
+            parts.append((cluster_ids, chunk))
+
+        if not parts:
+            raise ValueError('Input file [%s] has no members!' % opts.input_file)
+
+        data = dict((name, np.concatenate([chunk[name] for ids, chunk in parts]))
+                    for name in names)
+        cluster_ids = np.concatenate([ids for ids, chunk in parts]) \
+          if parts[0][0] is not None else None
+
+        if opts.cache:
+            write_cache(opts, names, [data[name] for name in names], cluster_ids)
+
+        # If a cluster ID is specified then save only the corresponding
+        # cluster members.
+        if opts.cluster_id:
+            index = cluster_ids == opts.cluster_id
+            data = dict((name, column[index]) for name, column in data.items())
+
+        # Otherwise keep the cluster ID of every member.
+        elif opts.all_ids:
+            data['cluster'] = cluster_ids
+
+    print ' Successfully read:', opts.input_file, '(%i members)' % len(data['id'])
+    print ' Peak memory: %.1f MB' % (getrusage(RUSAGE_SELF).ru_maxrss / 1024.0)
+
+    members = pd.DataFrame(data)
+
+    return members
+
+##
+#  Find the blocks of equal cluster IDs.
+#
+#  @param[in] cluster_ids: Cluster ID of each
+#  member.
+#
+#  @return Stable sort order and start and end
+#  of each block in the sorted order.
+#
+def cluster_blocks(cluster_ids):
+
+    order = np.argsort(cluster_ids, kind = 'mergesort')
+    ids_sorted = cluster_ids[order]
+
+    starts = np.flatnonzero(np.append(True, ids_sorted[1:] != ids_sorted[:-1]))
+    ends = np.append(starts[1:], len(ids_sorted))
+
+    return order, starts, ends
+
+##
+#  Split a DataFrame of members into clusters.
+#  The members are sorted by cluster ID once
+#  and each cluster is a contiguous block of
+#  the sorted order.
+#
+#  @param[in] data: DataFrame of members with
+#  a cluster column.
+#
+#  @return Generator of cluster ID and DataFrame
+#  of cluster members.
+#
+def group_clusters(data):
+
+    cluster_ids = np.asarray(data.cluster)
+    order, starts, ends = cluster_blocks(cluster_ids)
+
+    print ' Found', len(starts), 'clusters.'
+
+    for start, end in zip(starts, ends):
+        yield cluster_ids[order[start]], data.iloc[order[start:end]].reset_index(drop = True)
+
+##
+#  Stream the clusters of the input file. The
+#  file is read in chunks of opts.chunk_size
+#  rows. If the file is sorted by cluster ID
+#  (opts.sorted) each cluster is returned when
+#  its last member has been read. Otherwise the
+#  members are first spilled to SPILL_BUCKETS
+#  temporary files by a hash of the cluster ID
+#  and the clusters are grouped one bucket at a
+#  time. The peak memory is then set by the
+#  largest bucket, about 1 / SPILL_BUCKETS of
+#  the file (more if a few large clusters share
+#  a bucket), not by one chunk plus the largest
+#  cluster as with opts.sorted.
+#
+#  @param[in] opts: List of arguments.
+#
+#  @return Generator of cluster ID and DataFrame
+#  of cluster members.
+#
+#  @exception ValueError for an unsorted file
+#  with opts.sorted or a file with no members.
+#
+def stream_clusters(opts):
+
+    names = input_cols(opts)
+    n_clusters, n_read = 0, 0
+
+    if opts.sorted:
+
+        # Members of the current cluster from previous chunks.
+        current, parts, done = None, [], set()
+
+        for cluster_ids, chunk in read_chunks(opts, names):
+            chunk['cluster'] = cluster_ids
+            n_read += len(cluster_ids)
+            starts = np.flatnonzero(np.append(True, cluster_ids[1:] != cluster_ids[:-1]))
+
+            for start, end in zip(starts, np.append(starts[1:], len(cluster_ids))):
+                if cluster_ids[start] != current:
+                    if parts:
+                        yield current, merge_parts(parts)
+                        n_clusters += 1
+                        done.add(current)
+                    current, parts = cluster_ids[start], []
+                    if current in done:
+                        raise ValueError('Input file is not sorted by cluster ID (' +
+                                         current + '), run without --sorted.')
+                parts.append(dict((name, column[start:end])
+                                  for name, column in chunk.items()))
+
+        if parts:
+            yield current, merge_parts(parts)
+            n_clusters += 1
 
-    if opts.radial:
-        return pd.DataFrame({'id' : data[0],
-                            'new_r' : np.array(data[1], dtype = 'float64')})
-    
     else:
-        return pd.DataFrame({'id' : data[0],
-                            'ra' : np.array(data[1], dtype = 'float64'),
-                            'dec' : np.array(data[2], dtype = 'float64'),
-                            'z' : np.array(data[3], dtype = 'float64')})
+
+        buckets = [tempfile.TemporaryFile() for i in range(SPILL_BUCKETS)]
+
+        for cluster_ids, chunk in read_chunks(opts, names):
+            chunk['cluster'] = cluster_ids
+            n_read += len(cluster_ids)
+            bucket = pd.util.hash_array(cluster_ids) % SPILL_BUCKETS
+            order = np.argsort(bucket, kind = 'mergesort')
+            bounds = np.searchsorted(bucket[order], np.arange(SPILL_BUCKETS + 1))
+            for i in np.flatnonzero(np.diff(bounds)):
+                index = order[bounds[i]:bounds[i + 1]]
+                pickle.dump(dict((name, column[index]) for name, column in chunk.items()),
+                            buckets[i], 2)
+
+        for f_handle in buckets:
+            f_handle.seek(0)
+            parts = []
+            while True:
+                try:
+                    parts.append(pickle.load(f_handle))
+                except EOFError:
+                    break
+            f_handle.close()
+
+            if parts:
+                data = merge_parts(parts)
+                cluster_ids = np.asarray(data.cluster)
+                order, starts, ends = cluster_blocks(cluster_ids)
+                for start, end in zip(starts, ends):
+                    yield cluster_ids[order[start]], \
+                      data.iloc[order[start:end]].reset_index(drop = True)
+                    n_clusters += 1
+
+    if not n_read:
+        raise ValueError('Input file [%s] has no members!' % opts.input_file)
+
+    print ' Streamed', n_clusters, 'clusters from:', opts.input_file
+    print ' Peak memory: %.1f MB' % (getrusage(RUSAGE_SELF).ru_maxrss / 1024.0)
+
+##
+#  Merge chunks of members into a DataFrame.
+#
+#  @param[in] parts: List of dictionaries of
+#  columns.
+#
+#  @return DataFrame of members.
+#
+def merge_parts(parts):
+
+    return pd.DataFrame(dict((name, np.concatenate([part[name] for part in parts]))
+                             for name in parts[0]))
 
 ##
 #  Write ascii file with profile data.
@@ -76,7 +440,12 @@ def write_p_data(opts, p_data):
       'Initial Scale Radius [Mpc]: ' + str(opts.rs) + '\n' + \
       'Initial Background [Mpc^-2]: ' + str(opts.bg) + '\n' + \
       'Cluster Size [Mpc]: ' + str(opts.size) + '\n' + \
-      'Best fit parameter values. [Scale Radius, Background]'
+      'Best fit parameter values. [Scale Radius, Background'
+
+    if len(p_data[0]) > 2:
+        header += ', Beta]'
+    else:
+        header += ']'
 
     np.savetxt(output_file, np.array([p_data[0],]), header = header)
 
@@ -84,6 +453,42 @@ def write_p_data(opts, p_data):
 
     np.savetxt(f_handle, np.array([p_data[3],]),
                header = 'Chi-Squared value. [Goodness of fit, Probability]')
+
+    if 'limits' in p_data[4]:
+        np.savetxt(f_handle, np.array([p_data[4]['limits'],]),
+                   header = 'Scale radius 1-sigma interval (' + opts.cl_method +
+                   '). [Lower, Upper]')
+
+    if 'fisher' in p_data[4]:
+        if len(p_data[4]['fisher']) > 3:
+            fisher_header = ', Sigma Beta]'
+        else:
+            fisher_header = ']'
+        np.savetxt(f_handle, np.array([p_data[4]['fisher'],]),
+                   header = 'Fisher matrix errors. [Sigma Scale Radius, ' +
+                   'Sigma Background, Correlation' + fisher_header)
+
+    if 'binning' in p_data[4]:
+        np.savetxt(f_handle, np.array([p_data[4]['binning'],]),
+                   header = 'Binned likelihood error (' + str(opts.lik_bins) + ' bins). ' +
+                   '[Binned - Exact Likelihood, Scale Radius Shift, Background Shift]')
+
+    if 'bootstrap' in p_data[4]:
+        np.savetxt(f_handle, np.array([p_data[4]['bootstrap'],]),
+                   header = 'Bootstrap 1-sigma intervals (' + str(opts.bootstrap) +
+                   ' resamplings, seed ' + str(opts.seed) + '). [Scale Radius Lower, ' +
+                   'Scale Radius Upper, Background Lower, Background Upper]')
+
+    if 'mcmc' in p_data[4]:
+        if len(p_data[4]['mcmc']) > 3:
+            mcmc_header = ' (x3), Background (x3)]'
+        else:
+            mcmc_header = ' (x3)]'
+        np.savetxt(f_handle, np.array([p_data[4]['mcmc'],]),
+                   header = 'MCMC 16, 50, 84 percentiles (' + str(opts.mcmc) + ' steps, ' +
+                   str(opts.walkers) + ' walkers, seed ' + str(opts.seed) +
+                   '). [Scale Radius' + mcmc_header)
+
     np.savetxt(f_handle, np.array(p_data[1]).T,
                header = 'Density points. [Radius, Density, Density Error]')
     np.savetxt(f_handle, np.array(p_data[2]).T,
@@ -92,3 +497,58 @@ def write_p_data(opts, p_data):
     f_handle.close()
 
     print ' Outputting log data to: ' + output_file
+
+##
+#  Write ascii file with the results of all
+#  the clusters.
+#
+#  @param[in] opts: List of code options.
+#  @param[in] results: List of cluster ID,
+#  profile data and number of members for
+#  each cluster. Clusters with no profile data
+#  (failed fits) are written as nan.
+#
+def write_results(opts, results):
+
+    output_file = opts.input_file + '.results'
+
+    columns = ['Cluster ID', 'Members', 'Scale Radius', 'Background']
+    if opts.model == 'beta' and opts.fit_beta:
+        columns.append('Beta')
+    columns.extend(['Chi-Squared', 'Probability'])
+    if opts.confidence:
+        columns.extend(['Scale Radius Lower', 'Scale Radius Upper'])
+
+    f_handle = file(output_file, 'w')
+    f_handle.write('# Results file for cluster.py: ' + strftime('%c') + '\n' +
+                   '# Input File: ' + opts.input_file + '\n' +
+                   '# Model: ' + opts.model + '\n' +
+                   '# [' + ', '.join(columns) + ']\n')
+
+    for cluster_id, p_data, n_members in results:
+        if p_data is None:
+            values = [np.nan] * (len(columns) - 2)
+        else:
+            values = list(p_data[0]) + list(p_data[3])
+            if opts.confidence:
+                values.extend(p_data[4]['limits'])
+        f_handle.write(str(cluster_id) + ' ' + str(n_members) + ' ' +
+                       ' '.join('%.18e' % value for value in values) + '\n')
+
+    f_handle.close()
+
+    print ' Results for', len(results), 'clusters written to:', output_file
+
+##
+#  Write numpy file with the MCMC chain.
+#
+#  @param[in] opts: List of code options.
+#  @param[in] chain_data: Chain data.
+#
+def write_chain(opts, chain_data):
+
+    output_file = opts.input_file + '.chain.npz'
+
+    np.savez(output_file, **chain_data)
+
+    print ' MCMC chain written to:', output_file
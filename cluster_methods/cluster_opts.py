@@ -47,9 +47,34 @@ def get_opts():
     parser.add_argument('--id_col', dest = 'cluster_id_col', type = int, default = 0,
                         help = 'Cluster ID column number.')
 
+    parser.add_argument('--all_ids', action = 'store_true', dest = 'all_ids',
+                        help = 'Fit every cluster in the input file. Requires a cluster\n' +
+                        'ID column and writes one table of results.')
+
+    parser.add_argument('--chunk_size', dest = 'chunk_size', type = int, default = 0,
+                        help = 'Read the input file in chunks of this many rows.\n' +
+                        'With --all_ids the clusters are streamed to the fits.')
+
+    parser.add_argument('--sorted', action = 'store_true', dest = 'sorted',
+                        help = 'The input file is sorted by cluster ID.')
+
+    parser.add_argument('--cache', action = 'store_true', dest = 'cache',
+                        help = 'Cache the input columns in a binary file\n' +
+                        '(<input_file>.cache) that is read by later runs.')
+
     parser.add_argument('--centre', dest = 'centre', default = ['kde'], nargs = '+',
                         help = 'Cluster centre. Default (centre = \'kde\')')
 
+    parser.add_argument('--kde_method', dest = 'kde_method', default = 'direct',
+                        choices = ['direct', 'fft'],
+                        help = 'KDE centre method:' +
+                        '\n direct -- kernel evaluated at every grid point [Default]' +
+                        '\n fft -- binned members convolved with the kernel by FFT')
+
+    parser.add_argument('--kde_refine', dest = 'kde_refine', type = int, default = 0,
+                        help = 'Number of KDE grid peaks refined with zoom grids and a\n' +
+                        'local optimiser. Default (kde_refine = 0, grid centre)')
+
     parser.add_argument('-s', '--size', dest = 'size', default = '1.5', type = float,
                         help = 'Cluster radius in Mpc.')
 
@@ -65,6 +90,47 @@ def get_opts():
     parser.add_argument('--cl', action = 'store_true', dest = 'confidence',
                         help = 'Show results with confidence limits.')
 
+    parser.add_argument('--cl_method', dest = 'cl_method',
+                        choices = ['grid', 'profile', 'fisher'],
+                        help = 'Confidence limit method (implies --cl):' +
+                        '\n grid -- threshold the likelihood on a grid [Default]' +
+                        '\n profile -- root-find the profile likelihood in r_s' +
+                        '\n fisher -- errors from the likelihood Hessian')
+
+    parser.add_argument('--fit_method', dest = 'fit_method', default = 'slsqp',
+                        choices = ['slsqp', 'profile'],
+                        help = 'Fit method:' +
+                        '\n slsqp -- joint fit of r_s and background [Default]' +
+                        '\n profile -- 1-D search in r_s with the background profiled out')
+
+    parser.add_argument('--lik_bins', dest = 'lik_bins', type = int, default = 0,
+                        help = 'Number of log bins in projected radius used to\n' +
+                        'approximate the likelihood for large samples. Default (exact)')
+
+    parser.add_argument('--nfw_table', action = 'store_true', dest = 'nfw_table',
+                        help = 'Use lookup tables of the NFW profile in the likelihood.')
+
+    parser.add_argument('--bootstrap', dest = 'bootstrap', type = int, default = 0,
+                        help = 'Number of bootstrap resamplings of the members used to\n' +
+                        'estimate the errors on the scale radius and background.')
+
+    parser.add_argument('--seed', dest = 'seed', type = int,
+                        help = 'Random seed for the bootstrap and the MCMC. Default (random)')
+
+    parser.add_argument('--mcmc', dest = 'mcmc', type = int, default = 0,
+                        help = 'Number of MCMC steps used to sample the posterior of the\n' +
+                        'scale radius and background.')
+
+    parser.add_argument('--walkers', dest = 'walkers', type = int, default = 32,
+                        help = 'Number of MCMC walkers. Default (walkers = 32)')
+
+    parser.add_argument('--bg_sigma', dest = 'bg_sigma', type = float,
+                        help = 'Width of a Gaussian MCMC prior on the background\n' +
+                        'centred on the value from --bg or --sn.')
+
+    parser.add_argument('--jobs', dest = 'jobs', type = int, default = 1,
+                        help = 'Number of processes. Default (jobs = 1)')
+
     parser.add_argument('--log', action = 'store_true', dest = 'log',
                         help = 'Write profile data to an output log.')
 
@@ -73,6 +139,10 @@ def get_opts():
 
     parser.add_argument('--beta', default = 1.0, dest = 'beta', type = float,
                         help = 'Beta model coefficient. Default (beta = 1.0)')
+
+    parser.add_argument('--fit_beta', action = 'store_true', dest = 'fit_beta',
+                        help = 'Fit the beta model coefficient with the scale radius\n' +
+                        'and background. The value of --beta is used as the initial estimate.')
     
     parser.add_argument('--plot', default = ['profile'], nargs = '+', 
                         dest = 'plot', help = plot_help)
@@ -96,9 +166,44 @@ def check_opts(parser):
     if not opts.input_file:
         parser.error('argument --input_file: file name not provided.')
 
+    if opts.all_ids and opts.cluster_id:
+        parser.error('argument --all_ids: not allowed with argument --id.')
+
+    if opts.kde_refine < 0:
+        parser.error('argument --kde_refine: must be positive.')
+
+    if opts.chunk_size < 0:
+        parser.error('argument --chunk_size: must be positive.')
+
+    if opts.sorted and not (opts.all_ids and opts.chunk_size):
+        parser.error('argument --sorted: requires --all_ids and --chunk_size.')
+
     if len(opts.centre) > 2:
         parser.error('argument --centre: takes a maximum of two values.')        
         
+    if opts.cl_method:
+        opts.confidence = True
+    else:
+        opts.cl_method = 'grid'
+
+    if opts.lik_bins < 0:
+        parser.error('argument --lik_bins: must be positive.')
+
+    if opts.bootstrap < 0:
+        parser.error('argument --bootstrap: must be positive.')
+
+    if opts.mcmc < 0:
+        parser.error('argument --mcmc: must be positive.')
+
+    if opts.walkers < 4 or opts.walkers % 2:
+        parser.error('argument --walkers: must be an even number >= 4.')
+
+    if opts.bg_sigma is not None and not (opts.bg or opts.sn):
+        parser.error('argument --bg_sigma: requires --bg or --sn.')
+
+    if opts.jobs < 1:
+        parser.error('argument --jobs: must be at least 1.')
+
     if 'all' in opts.plot:
         opts.plot.extend(['zhist', 'radec', 'xy', 'kde', 'profile'])
 
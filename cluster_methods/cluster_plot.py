@@ -197,6 +197,9 @@ def plot_profile(opts, p_data):
              rho % p_data[0][1])
     plt.text(0.25 * plt.xlim()[1], 0.6 * plt.ylim()[1],
              r'$\chi^2 =$ %.3f' % p_data[3][0])
+    if len(p_data[0]) > 2:
+        plt.text(0.25 * plt.xlim()[1], 0.5 * plt.ylim()[1],
+                 r'$\beta =$ %.3f' % p_data[0][2])
         
     plt.title('Projected Best-Fit Profile')
 
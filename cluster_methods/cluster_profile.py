@@ -12,15 +12,772 @@
 import warnings
 import numpy as np
 from functools import partial
+from multiprocessing import Pool
 from scipy.stats import chi2, chisquare, ks_2samp, anderson_ksamp
-from scipy.optimize import minimize, brute
+from scipy.optimize import minimize, minimize_scalar, brentq
 from functions.stats import chi2_gof
+from functions.mcmc import ensemble_sampler
 from halo_methods.nfw import *
 from halo_methods.beta import *
-from biviano_py.biweight import bwt_ave
+from halo_methods.maxlik import (proj_num_density, num_density_derivs, proj_maxlik,
+                                  proj_maxlik_derivs)
+from biviano_py.biweight import bwt_ave_batch
 
 warnings.simplefilter('ignore')
 
+##
+#  Maximum size in bytes of the temporary
+#  arrays used to evaluate likelihood grids.
+GRID_BYTES = 2 ** 26
+
+##
+#  Number of bootstrap replicates drawn from
+#  each random stream and fitted together.
+BOOT_BLOCK = 100
+
+##
+#  Class for fitting a profile to a single
+#  cluster. The projected radii are sorted
+#  once and every quantity that does not
+#  depend on the model parameters is cached,
+#  so the optimiser, the confidence limits
+#  and the profile curve can evaluate the
+#  likelihood repeatedly without re-deriving
+#  them.
+class FitProblem():
+
+    ##
+    #  Initialisation method.
+    #
+    #  @param[in] R_proj: Projected radius.
+    #  @param[in] model: Profile model (nfw or beta).
+    #  @param[in] alpha: Beta model coefficient.
+    #  @param[in] weights: Optional weights.
+    #  @param[in] fit_bg: Option to fit background.
+    #  @param[in] fit_beta: Option to fit the beta
+    #  model coefficient.
+    #  @param[in] fpb: Factor?
+    #  @param[in] lik_bins: Optional number of log
+    #  bins used to approximate the likelihood.
+    #  @param[in] nfw_table: Option to use the NFW
+    #  lookup tables in the likelihood.
+    #
+    def __init__(self, R_proj, model = 'nfw', alpha = 1.0, weights = None,
+                 fit_bg = True, fit_beta = False, fpb = 1, lik_bins = 0,
+                 nfw_table = False):
+
+        order = np.argsort(R_proj)
+
+        self.R_proj = np.array(R_proj, dtype = 'float64')[order]
+        self.n_mem = len(self.R_proj)
+        self.R_lim = (self.R_proj[0], self.R_proj[-1])
+
+        # The likelihood is only weighted if weights are provided.
+        if weights is None:
+            self.weights = np.ones(self.n_mem)
+            self.lik_weights = None
+        else:
+            self.weights = np.array(weights, dtype = 'float64')[order]
+            self.lik_weights = self.weights
+        self.w_mean = np.sum(self.weights) / self.n_mem
+
+        # Radii and weights at which the likelihood is evaluated.
+        if lik_bins:
+            self.R_lik, self.w_lik = bin_radii(self.R_proj, self.weights, lik_bins)
+        else:
+            self.R_lik, self.w_lik = self.R_proj, self.lik_weights
+
+        self.model = model
+        self.alpha = alpha
+        self.fit_bg = fit_bg
+        self.fit_beta = (model == 'beta') and fit_beta
+        self.nfw_table = (model == 'nfw') and nfw_table
+        self.bg_max = self.n_mem / (np.pi * (self.R_lim[1] ** 2 - self.R_lim[0] ** 2))
+        self.npfree = 1 + int(fit_bg) + int(self.fit_beta)
+
+        # Bins of num_points members used for the density points.
+        self.num_points = fpb * int(np.sqrt(self.n_mem))
+        n_bins = self.n_mem // self.num_points - 1
+        self.bin_edges = np.append(0.0, self.R_proj[self.num_points *
+                                                    np.arange(1, n_bins + 1)])
+
+        self.best = None
+        self.bg_fixed = None
+        self.bg_guess = None
+
+    ##
+    #  Get the beta model coefficient for
+    #  a set of parameters.
+    #
+    #  @param[in] params: Model parameters.
+    #
+    def get_alpha(self, params):
+
+        if len(params) > 2:
+            return params[2]
+        else:
+            return self.alpha
+
+    ##
+    #  Negative log-likelihood. Every model goes
+    #  through proj_maxlik with the functions of
+    #  model_funcs().
+    #
+    #  @param[in] params: Scale radius, background
+    #  density [and beta model coefficient].
+    #
+    def loglike(self, params):
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs(self.get_alpha(params))
+
+        return proj_maxlik(params, self.R_lik, sd_func, mass_diff, self.w_lik, self.R_lim,
+                           self.n_mem)
+
+    ##
+    #  Gradient of the negative log-likelihood
+    #  with respect to the scale radius and
+    #  background density.
+    #
+    #  @param[in] params: Scale radius and
+    #  background density.
+    #
+    def grad(self, params):
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs(self.get_alpha(params))
+
+        return proj_maxlik_derivs(params, self.R_lik, sd_func, sd_deriv, mass_diff,
+                                  self.w_lik, self.R_lim, self.n_mem)
+
+    ##
+    #  Hessian of the negative log-likelihood
+    #  with respect to the scale radius and
+    #  background density.
+    #
+    #  @param[in] params: Scale radius and
+    #  background density.
+    #
+    def hess(self, params):
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs(self.get_alpha(params))
+
+        return proj_maxlik_derivs(params, self.R_lik, sd_func, sd_deriv, mass_diff,
+                                  self.w_lik, self.R_lim, self.n_mem, hessian = True)[1]
+
+    ##
+    #  Model functions used by the generic
+    #  likelihood routines.
+    #
+    #  @param[in] alpha: Optional beta model
+    #  coefficient.
+    #
+    #  @return Surface density, its derivatives
+    #  and the projected mass difference.
+    #
+    def model_funcs(self, alpha = None):
+
+        if alpha is None:
+            alpha = self.alpha
+
+        if self.model == 'beta':
+            return (partial(bm_proj_sd, alpha = alpha),
+                    partial(bm_proj_sd_deriv, alpha = alpha),
+                    partial(bm_proj_mass_range, alpha = alpha))
+        elif self.nfw_table:
+            return nfw_proj_sd_table, nfw_proj_sd_deriv, nfw_proj_mass_diff_table
+        else:
+            return nfw_proj_sd, nfw_proj_sd_deriv, nfw_proj_mass_diff
+
+    ##
+    #  Negative log-likelihood on a grid of
+    #  scale radii and background densities.
+    #  The grid is evaluated by broadcasting in
+    #  blocks of scale radius rows, and of members
+    #  if one row is too large, so that the
+    #  temporary arrays stay below max_bytes (or
+    #  one member column of the background grid).
+    #
+    #  @param[in] r_scale: Array of scale radii.
+    #  @param[in] bg_density: Array of background
+    #  densities.
+    #  @param[in] max_bytes: Maximum size of the
+    #  temporary arrays.
+    #
+    #  @return Likelihood surface with shape
+    #  (len(r_scale), len(bg_density)).
+    #
+    def loglike_grid(self, r_scale, bg_density, max_bytes = GRID_BYTES):
+
+        r_scale = np.asarray(r_scale, dtype = 'float64').ravel()
+        bg_density = np.asarray(bg_density, dtype = 'float64').ravel()
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs()
+
+        n_cols = min(self.R_lik.size, max(1, int(max_bytes // (8 * bg_density.size))))
+        n_rows = max(1, int(max_bytes // (8 * bg_density.size * n_cols)))
+        surface = np.zeros((r_scale.size, bg_density.size))
+
+        for i in range(0, r_scale.size, n_rows):
+            r_block = r_scale[i:i + n_rows, None]
+            sd = sd_func(self.R_lik / r_block[:, :, None])
+            for j in range(0, self.R_lik.size, n_cols):
+                w_block = None if self.w_lik is None else self.w_lik[j:j + n_cols]
+                surface[i:i + n_rows] += proj_maxlik((r_block, bg_density),
+                                                     self.R_lik[j:j + n_cols], sd_func,
+                                                     mass_diff, w_block, self.R_lim,
+                                                     self.n_mem, sd[..., j:j + n_cols])
+
+        return surface
+
+    ##
+    #  Projected number density profile.
+    #
+    #  @param[in] x: Projected radius.
+    #  @param[in] params: Optional model parameters.
+    #  Default (params = best-fit values).
+    #
+    #  @return Number density at x.
+    #
+    def profile(self, x, params = None):
+
+        if params is None:
+            params = self.best
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs(self.get_alpha(params))
+        nden = proj_num_density(params[0], params[1], self.R_lim, self.n_mem, mass_diff)
+
+        return nden * sd_func(x / params[0]) + params[1] * self.w_mean
+
+    ##
+    #  Find the best-fit parameters.
+    #
+    #  With method = 'profile' the background is
+    #  profiled out and the scale radius is found
+    #  with a bounded 1-D search in log(r_s) on
+    #  [0.001, 100 * R_max], which does not need an
+    #  initial scale radius. A free beta is always
+    #  fitted with SLSQP.
+    #
+    #  @param[in] r_scale_ini: Initial scale radius.
+    #  @param[in] bg_density_ini: Initial background density.
+    #  @param[in] method: Fit method (slsqp or profile).
+    #
+    #  @return Best-fit scale radius, background
+    #  density [and beta model coefficient].
+    #
+    def fit(self, r_scale_ini, bg_density_ini, method = 'slsqp'):
+
+        if not self.fit_bg:
+            self.bg_fixed = bg_density_ini
+
+        if method == 'profile' and not self.fit_beta:
+            log_bounds = (np.log(0.001), np.log(100.0 * self.R_lim[1]))
+            log_r_scale = minimize_scalar(lambda log_r: self.profile_solve(np.exp(log_r))[1],
+                                          bounds = log_bounds, method = 'bounded',
+                                          options = {'xatol': 1e-8}).x
+            r_scale = np.exp(log_r_scale)
+            self.best = np.array([r_scale, self.profile_bg(r_scale)])
+            return self.best
+
+        if self.fit_bg:
+            bg_bounds = (0.001, None)
+        else:
+            bg_bounds = (bg_density_ini, bg_density_ini)
+
+        params_ini = [r_scale_ini, bg_density_ini]
+        bounds = [(0.001, None), bg_bounds]
+        jac = self.grad
+
+        # No analytic derivative with respect to beta is available.
+        if self.fit_beta:
+            params_ini.append(self.alpha)
+            bounds.append((0.1, 5.0))
+            jac = None
+
+        self.best = minimize(self.loglike, params_ini, method = 'SLSQP', jac = jac,
+                             options={'disp': False}, bounds = bounds).x
+
+        if self.fit_beta:
+            self.alpha = self.best[2]
+
+        return self.best
+
+    ##
+    #  Parameter covariance matrix from the
+    #  inverse of the likelihood Hessian at the
+    #  best fit. The Hessian is analytic for the
+    #  scale radius and background. If beta is
+    #  fitted its row is obtained from central
+    #  differences of the analytic gradient.
+    #  Parameters that are held fixed have zero
+    #  variance. If the Hessian is not positive
+    #  definite, e.g. when the fit sits on a bound,
+    #  the free block is nan.
+    #
+    #  @param[in] step: Relative step in beta.
+    #
+    #  @return Covariance matrix of the best-fit
+    #  parameters.
+    #
+    def covariance(self, step = 1e-4):
+
+        hess = self.hess(self.best)
+
+        if self.fit_beta:
+            h = step * self.alpha
+            params_up = np.append(self.best[:2], self.alpha + h)
+            params_down = np.append(self.best[:2], self.alpha - h)
+            h_beta = (self.grad(params_up) - self.grad(params_down)) / (2.0 * h)
+            h_bb = (self.loglike(params_up) - 2.0 * self.loglike(self.best) +
+                    self.loglike(params_down)) / h ** 2
+            hess = np.vstack([np.column_stack([hess, h_beta]), np.append(h_beta, h_bb)])
+
+        free = [0] + [1] * self.fit_bg + [2] * self.fit_beta
+        cov = np.zeros(hess.shape)
+        try:
+            chol_inv = np.linalg.inv(np.linalg.cholesky(hess[np.ix_(free, free)]))
+            cov[np.ix_(free, free)] = np.dot(chol_inv.T, chol_inv)
+        except np.linalg.LinAlgError:
+            cov[np.ix_(free, free)] = np.nan
+
+        return cov
+
+    ##
+    #  Background density that minimises the
+    #  likelihood for a fixed scale radius, and
+    #  the minimum likelihood. For a fixed scale
+    #  radius p = p_0 + bg * p_b is linear in the
+    #  background, so the likelihood is convex in
+    #  bg. It is minimised on [0.001, bg_max) with
+    #  a Newton iteration guarded by a bisection
+    #  bracket, and the surface density is only
+    #  evaluated once. p_0 and p_b come from the
+    #  number density normalisation and its bg
+    #  derivative, and the minimum is evaluated
+    #  with proj_maxlik. The fixed background is
+    #  used if the background is not fitted.
+    #
+    #  @param[in] r_scale: Scale radius.
+    #  @param[in] tol: Tolerance on the background
+    #  relative to bg_max.
+    #
+    #  @return Background density and negative
+    #  log-likelihood.
+    #
+    def profile_solve(self, r_scale, tol = 1e-10):
+
+        if not self.fit_bg:
+            return self.bg_fixed, self.loglike([r_scale, self.bg_fixed])
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs()
+        sd = sd_func(self.R_lik / r_scale)
+        nden = num_density_derivs(r_scale, 0.0, self.R_lim, self.n_mem, sd_func, sd_deriv,
+                                  mass_diff)
+        prob_0 = nden[0] * sd
+        prob_b = nden[2] * sd + 1.0
+
+        if self.w_lik is None:
+            weights = np.ones(prob_0.size)
+        else:
+            weights = self.w_lik
+
+        def derivs(bg_density):
+            ratio = prob_b / (prob_0 + bg_density * prob_b)
+            return -np.dot(weights, ratio), np.dot(weights, ratio ** 2)
+
+        # The upper limit keeps the normalisation positive.
+        low, high = 0.001, self.bg_max * (1.0 - 1e-9)
+        bg_density = low
+
+        if derivs(low)[0] < 0:
+            if self.bg_guess is not None and low < self.bg_guess < high:
+                bg_density = self.bg_guess
+            else:
+                bg_density = 0.5 * (low + high)
+
+            for i in range(100):
+                grad, hess = derivs(bg_density)
+                if grad > 0:
+                    high = bg_density
+                else:
+                    low = bg_density
+                bg_new = bg_density - grad / hess
+                if not low < bg_new < high:
+                    bg_new = 0.5 * (low + high)
+                converged = abs(bg_new - bg_density) < tol * self.bg_max
+                bg_density = bg_new
+                if converged:
+                    break
+
+            self.bg_guess = bg_density
+
+        return bg_density, proj_maxlik((r_scale, bg_density), self.R_lik, sd_func, mass_diff,
+                                       self.w_lik, self.R_lim, self.n_mem, sd)
+
+    ##
+    #  Background density that minimises the
+    #  likelihood for a fixed scale radius.
+    #  Returns the fixed background if the
+    #  background is not fitted.
+    #
+    #  @param[in] r_scale: Scale radius.
+    #
+    def profile_bg(self, r_scale):
+
+        return self.profile_solve(r_scale)[0]
+
+    ##
+    #  Profile negative log-likelihood, i.e. the
+    #  likelihood minimised over the background
+    #  density, for a fixed scale radius.
+    #
+    #  @param[in] r_scale: Scale radius.
+    #
+    def profile_loglike(self, r_scale):
+
+        return self.profile_solve(r_scale)[1]
+
+    ##
+    #  Bootstrap the best-fit scale radius and
+    #  background. Replicates are drawn in blocks
+    #  of BOOT_BLOCK, each from its own random
+    #  stream seeded with (seed, block number), so
+    #  the result only depends on the seed and not
+    #  on the number of processes. A free beta is
+    #  held at its best-fit value.
+    #
+    #  @param[in] n_boot: Number of replicates.
+    #  @param[in] seed: Random seed.
+    #  @param[in] jobs: Number of processes.
+    #
+    #  @return Array of replicate fits with shape
+    #  (n_boot, 2). Replicates that could not be
+    #  fitted are nan.
+    #
+    def bootstrap(self, n_boot, seed, jobs = 1):
+
+        tasks = [(self, seed, block, min(BOOT_BLOCK, n_boot - start))
+                 for block, start in enumerate(range(0, n_boot, BOOT_BLOCK))]
+
+        if jobs > 1:
+            pool = Pool(jobs)
+            fits = pool.map(bootstrap_block, tasks)
+            pool.close()
+            pool.join()
+        else:
+            fits = map(bootstrap_block, tasks)
+
+        return np.vstack(fits)
+
+    ##
+    #  Log-posterior of an ensemble of walkers.
+    #  The prior is flat in the scale radius on
+    #  [0.001, 100 * R_max] and in the background
+    #  on [0.001, bg_max), or Gaussian within
+    #  these bounds if bg_prior is given. All the
+    #  walkers inside the prior are evaluated in
+    #  one call to the likelihood.
+    #
+    #  @param[in] pos: Walker positions with shape
+    #  (n_walkers, 1) for the scale radius only or
+    #  (n_walkers, 2) with the background.
+    #  @param[in] bg_prior: Optional mean and
+    #  standard deviation of the background.
+    #
+    #  @return Log-posterior of each walker.
+    #
+    def log_posterior(self, pos, bg_prior = None):
+
+        # The background bounds only apply to a sampled background, a
+        # fixed one is used as given.
+        r_scale = pos[:, 0]
+        inside = (r_scale >= 0.001) & (r_scale <= 100.0 * self.R_lim[1])
+        if pos.shape[1] > 1:
+            bg_density = pos[:, 1]
+            inside &= (bg_density >= 0.001) & (bg_density < self.bg_max)
+        else:
+            bg_density = np.ones(len(pos)) * self.best[1]
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs()
+
+        log_post = np.ones(len(pos)) * -np.inf
+        log_post[inside] = -proj_maxlik((r_scale[inside], bg_density[inside]), self.R_lik,
+                                        sd_func, mass_diff, self.w_lik, self.R_lim,
+                                        self.n_mem)
+
+        if bg_prior is not None:
+            log_post -= 0.5 * ((bg_density - bg_prior[0]) / bg_prior[1]) ** 2
+
+        return log_post
+
+    ##
+    #  Sample the posterior of the scale radius
+    #  and background with an ensemble MCMC
+    #  started in a small ball around the best
+    #  fit. The background is only sampled if it
+    #  is fitted or has a prior. A free beta is
+    #  held at its best-fit value.
+    #
+    #  @param[in] n_steps: Number of steps.
+    #  @param[in] n_walkers: Number of walkers.
+    #  @param[in] seed: Random seed.
+    #  @param[in] bg_prior: Optional mean and
+    #  standard deviation of the background.
+    #
+    #  @return Chain, log-posteriors and
+    #  acceptance fractions.
+    #
+    def sample(self, n_steps, n_walkers, seed, bg_prior = None):
+
+        rng = np.random.RandomState(seed)
+
+        n_dim = 1 + int(self.fit_bg or bg_prior is not None)
+        centre = np.array(self.best[:n_dim])
+        if bg_prior is not None and not self.fit_bg:
+            centre[1] = bg_prior[0]
+        centre[1:] = np.clip(centre[1:], 0.001, self.bg_max)
+
+        p_ini = centre * (1.0 + 1e-3 * rng.randn(n_walkers, n_dim))
+        p_ini[:, 0] = np.maximum(p_ini[:, 0], 0.001)
+        p_ini[:, 1:] = np.clip(p_ini[:, 1:], 0.001, self.bg_max * (1.0 - 1e-6))
+
+        return ensemble_sampler(partial(self.log_posterior, bg_prior = bg_prior), p_ini,
+                                n_steps, rng = rng)
+
+    ##
+    #  Error of the binned likelihood at a set of
+    #  parameters. The exact likelihood and its
+    #  gradient over all the members are evaluated
+    #  once and a Newton step with the binned
+    #  Hessian estimates the shift of the exact
+    #  optimum from the binned one.
+    #
+    #  @param[in] params: Optional model parameters.
+    #  Default (params = best-fit values).
+    #
+    #  @return Binned minus exact likelihood and
+    #  the estimated shift of the scale radius and
+    #  background density.
+    #
+    def binning_error(self, params = None):
+
+        if params is None:
+            params = self.best
+
+        sd_func, sd_deriv, mass_diff = self.model_funcs()
+        r_scale_bg = np.array(params[:2], dtype = 'float64')
+
+        exact = proj_maxlik(r_scale_bg, self.R_proj, sd_func, mass_diff, self.lik_weights,
+                            self.R_lim)
+        grad = proj_maxlik_derivs(r_scale_bg, self.R_proj, sd_func, sd_deriv, mass_diff,
+                                  self.lik_weights, self.R_lim)
+
+        free = [0] + [1] * self.fit_bg
+        shift = np.zeros(2)
+        shift[free] = -np.linalg.solve(self.hess(params)[np.ix_(free, free)], grad[free])
+
+        return self.loglike(params) - exact, shift
+
+    ##
+    #  Get number density of points along the
+    #  projected radius of the cluster.
+    #
+    #  @return Projected radius, projected density
+    #  and errors.
+    #
+    def get_points(self):
+
+        return get_points(self.R_proj, self.num_points, self.weights, self.bin_edges)
+
+##
+#  Bin the projected radii in log-spaced bins
+#  for the approximate likelihood. Each bin is
+#  represented by the weighted geometric mean
+#  radius of its members, so the first order
+#  error of the approximation cancels, and by
+#  the total weight of its members. Empty bins
+#  are dropped. Members at R = 0 are put in the
+#  first bin at the smallest positive radius, as
+#  log(R) is not finite there.
+#
+#  @param[in] R_proj: Sorted projected radius.
+#  @param[in] weights: Member weights.
+#  @param[in] n_bins: Number of bins.
+#
+#  @return Bin radii and weights.
+#
+def bin_radii(R_proj, weights, n_bins):
+
+    log_R = np.log(np.maximum(R_proj, R_proj[R_proj > 0][0]))
+    edges = np.linspace(log_R[0], log_R[-1], n_bins + 1)
+    index = np.clip(np.searchsorted(edges, log_R, side = 'right') - 1, 0, n_bins - 1)
+
+    w_bin = np.bincount(index, weights, n_bins)
+    log_R_bin = np.bincount(index, weights * log_R, n_bins)
+    full = w_bin > 0
+
+    return np.exp(log_R_bin[full] / w_bin[full]), w_bin[full]
+
+##
+#  Fit many samples of projected radii at once
+#  with a damped Newton iteration in (log(r_s),
+#  bg) that uses the analytic gradient and
+#  Hessian. All samples are evaluated together
+#  as 2-D arrays and samples drop out of the
+#  iteration as they converge.
+#
+#  @param[in] R_proj: Projected radii with shape
+#  (n_samples, n_members).
+#  @param[in] params_ini: Initial scale radius
+#  and background density.
+#  @param[in] funcs: Model functions from
+#  FitProblem.model_funcs().
+#  @param[in] fit_bg: Option to fit background.
+#  @param[in] weights: Optional weights.
+#  @param[in] max_iter: Maximum number of
+#  iterations.
+#  @param[in] tol: Convergence tolerance on the
+#  step in log(r_s) and relative step in bg.
+#
+#  @return Array of fits with shape
+#  (n_samples, 2). Samples whose line search
+#  fails even with the background held are nan.
+#
+def fit_batch(R_proj, params_ini, funcs, fit_bg = True, weights = None,
+              max_iter = 100, tol = 1e-8):
+
+    sd_func, sd_deriv, mass_diff = funcs
+
+    n_samp, n_mem = R_proj.shape
+    R_lim = (np.min(R_proj, axis = 1), np.max(R_proj, axis = 1))
+
+    # Keep the background in the range where the number density
+    # normalisation is positive.
+    bg_max = n_mem / (np.pi * (R_lim[1] ** 2 - R_lim[0] ** 2)) * (1.0 - 1e-6)
+    log_r_min = np.log(0.001)
+
+    # A fixed background is kept as given, the likelihood only floors
+    # the normalisation.
+    log_r = np.ones(n_samp) * np.log(params_ini[0])
+    bg = np.ones(n_samp) * params_ini[1]
+    if fit_bg:
+        bg = np.minimum(bg, bg_max)
+    active = np.ones(n_samp, dtype = 'bool')
+    retry = np.zeros(n_samp, dtype = 'bool')
+    failed = np.zeros(n_samp, dtype = 'bool')
+
+    # Newton step with the background and/or the scale radius dropped
+    # from the step.
+    def newton_step(g_0, g_1, h_00, h_01, h_11, bg_fixed, r_fixed):
+        g_1, h_01, h_11 = (np.where(bg_fixed, 0.0, g_1), np.where(bg_fixed | r_fixed, 0.0, h_01),
+                           np.where(bg_fixed, 1.0, h_11))
+        g_0, h_00 = np.where(r_fixed, 0.0, g_0), np.where(r_fixed, 1.0, h_00)
+
+        # Shift the Hessian where it is not positive definite.
+        eig_min = 0.5 * (h_00 + h_11) - np.sqrt(0.25 * (h_00 - h_11) ** 2 + h_01 ** 2)
+        shift = np.where(eig_min > 0, 0.0, 1e-6 * (np.abs(h_00) + np.abs(h_11)) - eig_min)
+        h_00, h_11 = h_00 + shift, h_11 + shift
+        det = h_00 * h_11 - h_01 ** 2
+
+        return (np.clip(-(h_11 * g_0 - h_01 * g_1) / det, -1.0, 1.0),
+                -(h_00 * g_1 - h_01 * g_0) / det)
+
+    for i in range(max_iter):
+
+        index = np.flatnonzero(active)
+        if index.size == 0:
+            break
+
+        R_a = R_proj[index]
+        lim_a = (R_lim[0][index], R_lim[1][index])
+        w_a = None if weights is None else weights[index]
+        r_a, bg_a = np.exp(log_r[index]), bg[index]
+
+        loglike = proj_maxlik((r_a, bg_a), R_a, sd_func, mass_diff, w_a, lim_a)
+        grad, hess = proj_maxlik_derivs((r_a, bg_a), R_a, sd_func, sd_deriv,
+                                        mass_diff, w_a, lim_a, hessian = True)
+
+        # Derivatives with respect to log(r_s).
+        g_0, g_1 = grad[0] * r_a, grad[1]
+        h_00 = hess[0, 0] * r_a ** 2 + g_0
+        h_01, h_11 = hess[0, 1] * r_a, hess[1, 1]
+
+        # Hold the background where it is fixed, where it is pushed
+        # against a bound (within a tolerance, as SLSQP stops just inside
+        # it) or where the last line search failed, and likewise the
+        # scale radius.
+        at_low = (bg_a <= 0.001 * (1.0 + 1e-6)) & (g_1 > 0) & fit_bg
+        at_high = (bg_a >= bg_max[index] * (1.0 - 1e-6)) & (g_1 < 0) & fit_bg
+        bg_fixed = at_low | at_high | retry[index] | (not fit_bg)
+        r_fixed = (log_r[index] <= log_r_min) & (g_0 > 0)
+        step_0, step_1 = newton_step(g_0, g_1, h_00, h_01, h_11, bg_fixed, r_fixed)
+
+        # If the joint step takes the background through the bound it is
+        # pushed against, hold it on the bound and step in the scale
+        # radius only.
+        cross_low = ~bg_fixed & (bg_a + step_1 < 0.001) & (g_1 > 0)
+        cross_high = ~bg_fixed & (bg_a + step_1 > bg_max[index]) & (g_1 < 0)
+        if np.any(cross_low | cross_high):
+            at_low, at_high = at_low | cross_low, at_high | cross_high
+            bg_fixed |= cross_low | cross_high
+            step_0, step_1 = newton_step(g_0, g_1, h_00, h_01, h_11, bg_fixed, r_fixed)
+        bg_hold = np.where(at_low, 0.001, np.where(at_high, bg_max[index], bg_a))
+
+        converged = ((np.abs(step_0) < tol) & (np.abs(step_1) < tol * np.maximum(bg_a, 1.0)) &
+                     (bg_hold == bg_a))
+
+        # Halve the steps until the likelihood does not increase.
+        todo = np.ones(index.size, dtype = 'bool')
+        for j in range(30):
+            log_r_new = np.maximum(log_r[index] + step_0, log_r_min)
+            bg_new = np.where(bg_fixed, bg_hold, np.clip(bg_a + step_1, 0.001, bg_max[index]))
+            loglike_new = proj_maxlik((np.exp(log_r_new[todo]), bg_new[todo]), R_a[todo],
+                                      sd_func, mass_diff,
+                                      None if w_a is None else w_a[todo],
+                                      (lim_a[0][todo], lim_a[1][todo]))
+            done = np.zeros(index.size, dtype = 'bool')
+            done[todo] = loglike_new <= loglike[todo] + 1e-12 * np.abs(loglike[todo])
+            log_r[index[done]], bg[index[done]] = log_r_new[done], bg_new[done]
+            todo &= ~done
+            if not np.any(todo):
+                break
+            step_0[todo] *= 0.5
+            step_1[todo] *= 0.5
+
+        # A failed line search is retried with the background held, and
+        # flagged if it fails with the background held.
+        stuck = todo & ~converged
+        retry[index] = stuck & ~bg_fixed
+        failed[index[stuck & bg_fixed]] = True
+        active[index[converged | (stuck & bg_fixed)]] = False
+
+    fits = np.column_stack([np.exp(log_r), bg])
+    fits[failed] = np.nan
+
+    return fits
+
+##
+#  Fit one block of bootstrap replicates.
+#
+#  @param[in] args: FitProblem, seed, block
+#  number and number of replicates.
+#
+#  @return Array of replicate fits.
+#
+def bootstrap_block(args):
+
+    problem, seed, block, n_boot = args
+
+    rng = np.random.RandomState([seed, block])
+    index = rng.randint(0, problem.n_mem, size = (n_boot, problem.n_mem))
+
+    if problem.lik_weights is None:
+        weights = None
+    else:
+        weights = problem.lik_weights[index]
+
+    return fit_batch(problem.R_proj[index], problem.best[:2], problem.model_funcs(),
+                     problem.fit_bg, weights)
+
 ##
 #  Get number density of points along the 
 #  projected radius of the cluster.
@@ -31,66 +788,150 @@ warnings.simplefilter('ignore')
 #  @param[in] R_proj: Projected radius.
 #  @param[in] num_points: Number of points
 #  @param[in] weights: Optional weights.
+#  @param[in] bin_edges: Optional precomputed
+#  bin edges.
 #
 #  @return Projected radius, projected density
 #  and errors.
 #
-def get_points(R_proj, num_points, weights):
-        
-    radial_pt = []
-    density_pt = []
-    density_pt_err = []
-
-    for i in range(len(R_proj) / num_points - 1): 
-        r_biweight = bwt_ave(R_proj[num_points * i:num_points * \
-                                    (i + 1)])
-        radial_pt.append(r_biweight[0][0])
-        if i == 0:
-            r1 = 0.
-        if i > 0:
-            r1 = r2
-        r2 = R_proj[num_points * (i + 1)]
-        weight = np.sum(weights[num_points * i:num_points * (i + 1)])
-        density_pt.append(weight / (np.pi * (r2 ** 2 - r1 ** 2)))
-        density_pt_err.append(np.sqrt(num_points) / num_points * weight / \
-                   (np.pi * (r2 ** 2 - r1 ** 2)))
-
-    return np.array(radial_pt), np.array(density_pt), np.array(density_pt_err)
+def get_points(R_proj, num_points, weights, bin_edges = None):
+
+    # Blocks of num_points members. The last full block and any
+    # remaining members are not used.
+    n_bins = max(len(R_proj) // num_points - 1, 0)
+    n_used = n_bins * num_points
+
+    if bin_edges is None:
+        bin_edges = np.append(0.0, R_proj[num_points * np.arange(1, n_bins + 1)])
+
+    radial_pt = bwt_ave_batch(np.reshape(R_proj[:n_used], (n_bins, num_points)))[0][0]
+
+    weight = np.sum(np.reshape(weights[:n_used], (n_bins, num_points)), axis = 1)
+    # np.power evaluates pow() as scalar arithmetic does. The array
+    # ** 2 squares with x * x, which can differ in the last digit.
+    edges_sq = np.power(bin_edges[:n_bins + 1], 2.0)
+    area = np.pi * (edges_sq[1:] - edges_sq[:-1])
+
+    density_pt = weight / area
+    density_pt_err = np.sqrt(num_points) / num_points * weight / area
+
+    return radial_pt, density_pt, density_pt_err
 
 ##
 #  Get confidence limits for best-fit scale 
 #  radius.
 #
-#  @param[in] r_scale: Best scale radius.
-#  @param[in] bg_density: Best background density.
-#  @param[in] R_proj: Projected radius.
+#  @param[in] problem: FitProblem with best-fit
+#  parameters.
 #  @param[in] grid: Number of grid points.
-#  @param[in] dof: Degree of freedom.
 #
 #  @return Lower and upper confidence limits.
 #
-def confidence(opts, r_scale, bg_density, R_proj, grid, dof):
+def confidence(problem, grid):
     
     def get_range(value, grid):
         a = tuple(10.0 ** (np.log10(value) + np.array([-grid / 2, grid / 2]) * 1.4 / grid))
         b = (np.max(a) - np.min(a)) / grid * 2.0
         return a + (b,)
 
-    ranges = (get_range(r_scale, grid), get_range(bg_density, grid))
+    r_scale = np.mgrid[slice(*get_range(problem.best[0], grid))]
+    bg_density = np.mgrid[slice(*get_range(problem.best[1], grid))]
 
-    if opts.model == 'beta':
-        res = brute(bm_proj_maxlik_bg, ranges, args = (R_proj, opts.beta, ), full_output = True)
+    surface = problem.loglike_grid(r_scale, bg_density)
+
+    index = np.any(2.0 * (surface - np.min(surface)) <= chi2.ppf(0.68, problem.npfree),
+                   axis = 1)
+    limits = r_scale[index]
 
+    return np.min(limits), np.max(limits)
+
+##
+#  Get confidence limits for best-fit scale
+#  radius from the profile likelihood. The
+#  points where 2 * (L_prof(r_s) - L_min)
+#  crosses the same chi^2 threshold used by
+#  confidence() are bracketed in log(r_s) and
+#  then found with Brent's method, so the
+#  limits are not limited by a grid spacing.
+#
+#  @param[in] problem: FitProblem with best-fit
+#  parameters.
+#  @param[in] xtol: Tolerance on log(r_s).
+#
+#  @return Lower and upper confidence limits.
+#  A limit that is not reached within the
+#  allowed range of r_s is returned as the
+#  range boundary.
+#
+def confidence_profile(problem, xtol = 1e-6):
+
+    loglike_min = problem.loglike(problem.best)
+    delta = chi2.ppf(0.68, problem.npfree)
+
+    def excess(log_r_scale):
+        return 2.0 * (problem.profile_loglike(np.exp(log_r_scale)) - loglike_min) - delta
+
+    log_best = np.log(problem.best[0])
+    log_bounds = (np.log(0.001), np.log(100.0 * problem.R_lim[1]))
+
+    limits = []
+
+    for sign, log_bound in zip((-1.0, 1.0), log_bounds):
+
+        inner, step = log_best, 0.05
+        outer = log_best + sign * step
+
+        # Expand the bracket until the threshold is crossed.
+        while sign * (log_bound - outer) > 0 and excess(outer) < 0:
+            inner, step = outer, 2.0 * step
+            outer = inner + sign * step
+
+        if sign * (log_bound - outer) <= 0:
+            outer = log_bound
+            if excess(outer) < 0:
+                limits.append(np.exp(log_bound))
+                continue
+
+        limits.append(np.exp(brentq(excess, min(inner, outer), max(inner, outer),
+                                    xtol = xtol)))
+
+    return limits[0], limits[1]
+
+##
+#  Get confidence limits for best-fit scale
+#  radius from the Fisher matrix, i.e. the
+#  likelihood Hessian at the best fit. The
+#  interval is the quadratic approximation of
+#  the threshold used by confidence(). The
+#  limits and errors are nan if the Hessian is
+#  not positive definite.
+#
+#  @param[in] problem: FitProblem with best-fit
+#  parameters.
+#
+#  @return Lower and upper confidence limits
+#  and the parameter errors [sigma(r_s),
+#  sigma(bg), correlation(r_s, bg) (,
+#  sigma(beta))].
+#
+def confidence_fisher(problem):
+
+    cov = problem.covariance()
+    sigma = np.sqrt(np.diag(cov))
+
+    if np.isnan(sigma[0]):
+        return (np.nan, np.nan), [np.nan, np.nan, np.nan] + list(sigma[2:])
+
+    if sigma[0] > 0 and sigma[1] > 0:
+        corr = cov[0, 1] / (sigma[0] * sigma[1])
     else:
-        res = brute(nfw_proj_maxlik_bg, ranges, args = (R_proj, ), full_output = True)
+        corr = 0.0
 
-    x, y = np.array(res[2]), np.array(res[3]).flatten()
-    x = x.reshape(x.shape[0], x.shape[1] * x.shape[2]).T
-    
-    index = (2.0 * (y - np.min(y)) <= chi2.ppf(0.68, dof))
-    limits = x[index, 0]
+    errors = [sigma[0], sigma[1], corr] + list(sigma[2:])
 
-    return np.min(limits), np.max(limits)
+    half_width = np.sqrt(chi2.ppf(0.68, problem.npfree)) * sigma[0]
+
+    return (max(problem.best[0] - half_width, 0.0), problem.best[0] + half_width), errors
 
 ##
 #  Minimisation of profile with background density.
@@ -108,8 +949,8 @@ def confidence(opts, r_scale, bg_density, R_proj, grid, dof):
 #  @param[in] weights: Optional weights.
 #
 #  @return Best-fit scale radius and background density,
-#  projected density points with errors, fit to data and
-#  chi-squared test results.
+#  projected density points with errors, fit to data,
+#  chi-squared test results and confidence results.
 #
 def best_fit(opts, R_proj, r_scale_ini, grid, bg_density_ini = 0.0, fit_bg = True,
                    fpb = 1, weights = None):
@@ -120,59 +961,36 @@ def best_fit(opts, R_proj, r_scale_ini, grid, bg_density_ini = 0.0, fit_bg = Tru
         print ' Fitting the scale radius only for', len(R_proj), 'members.'
     print ' Initial estimates of parameters: ', r_scale_ini, bg_density_ini
 
-    if weights is None:
-        weights = np.ones(len(R_proj))
-
-    # Sort data
-    R_proj = R_proj[np.argsort(R_proj)]
-    weights = weights[np.argsort(R_proj)]
+    problem = FitProblem(R_proj, opts.model, opts.beta, weights, fit_bg, opts.fit_beta, fpb,
+                         opts.lik_bins, opts.nfw_table)
+    if opts.lik_bins:
+        print ' Binned likelihood with', problem.R_lik.size, 'non-empty bins.'
 
     # Get number density for various points along R_proj 
-    num_points = fpb * int(np.sqrt(len(R_proj)))
-    if num_points < 5:
-        print ' Only ', len(R_proj), 'data - not enough for the profiles'
-    rd, dp, edp = get_points(R_proj, num_points, weights)
-
-    # Find best values for scale radius and background density
-    if not fit_bg:
-        bg_bounds = (bg_density_ini, bg_density_ini)
-    else:
-        bg_bounds = (0.001, None)
-
-    # Get fit to profile      
-    x_fit = np.arange(0.001, 5.0, 0.005)
+    if problem.num_points < 5:
+        print ' Only ', problem.n_mem, 'data - not enough for the profiles'
+    rd, dp, edp = problem.get_points()
 
     if opts.model == 'beta':
-
-        print ' Using beta model. [Beta = ' + str(opts.beta) + ']'
-        
-        r_scale_best, bg_density_best = minimize(bm_proj_maxlik_bg, [r_scale_ini, bg_density_ini],
-                                                 args = (R_proj, opts.beta, ), method = 'SLSQP',
-                                                 options={'disp': False},
-                                                 bounds = ((0.001, None), bg_bounds)).x
-    
-        y_fit = bm_num_density(R_proj, r_scale_best, bg_density_best, opts.beta) * \
-          np.array(map(partial(bm_proj_sd, alpha = opts.beta), (x_fit / r_scale_best))) + \
-          bg_density_best * np.sum(weights) / len(R_proj)
-
+        if problem.fit_beta:
+            print ' Using beta model. [Beta = free, initial = ' + str(opts.beta) + ']'
+        else:
+            print ' Using beta model. [Beta = ' + str(opts.beta) + ']'
+    elif problem.nfw_table:
+        print ' Using NFW profile. [Lookup table, rtol = ' + str(NFW_TABLE_RTOL) + ']'
     else:
-
         print ' Using NFW profile.'
-          
-        r_scale_best, bg_density_best = minimize(nfw_proj_maxlik_bg, [r_scale_ini, bg_density_ini],
-                                                 args = (R_proj, ), method = 'SLSQP',
-                                                 options={'disp': False},
-                                                 bounds = ((0.001, None), bg_bounds)).x
 
-        y_fit = nfw_num_density(R_proj, r_scale_best, bg_density_best) * \
-          np.array(map(nfw_proj_sd, (x_fit / r_scale_best))) + \
-          bg_density_best * np.sum(weights) / len(R_proj)
+    # Find best values for scale radius and background density
+    best_params = list(problem.fit(r_scale_ini, bg_density_ini, opts.fit_method))
+    r_scale_best, bg_density_best = best_params[:2]
+
+    # Get fit to profile      
+    x_fit = np.arange(0.001, 5.0, 0.005)
+    y_fit = problem.profile(x_fit)
 
     # Evaluate chi^2
-    if fit_bg:
-        npfree = 2
-    else:
-        npfree = 1
+    npfree = problem.npfree
         
     chi2_param = chi2_gof(np.interp(rd, x_fit, y_fit), dp, edp, npfree)
 
@@ -182,16 +1000,77 @@ def best_fit(opts, R_proj, r_scale_ini, grid, bg_density_ini = 0.0, fit_bg = Tru
     # Evaluate A-D test
     ad_param = anderson_ksamp([np.interp(rd, x_fit, y_fit), dp])
 
+    cf_data = {}
+
+    if opts.lik_bins:
+        # Compare the binned likelihood with the exact one
+        d_loglike, shift = problem.binning_error()
+        cf_data['binning'] = np.append(d_loglike, shift)
+
     if opts.confidence:
         # Evaluate confidence intervals for r_s
-        cf_limits = confidence(opts, r_scale_best, bg_density_best, R_proj, grid, npfree)
+        if opts.cl_method == 'profile':
+            cf_limits = confidence_profile(problem)
+        elif opts.cl_method == 'fisher':
+            cf_limits, cf_data['fisher'] = confidence_fisher(problem)
+        else:
+            cf_limits = confidence(problem, grid)
+        cf_data['limits'] = cf_limits
+
+    if (opts.bootstrap or opts.mcmc) and opts.seed is None:
+        opts.seed = np.random.randint(2 ** 31 - 1)
+
+    if opts.bootstrap:
+        # Evaluate bootstrap intervals for r_s and the background
+        # Replicates that could not be fitted are nan and are left out.
+        boot = problem.bootstrap(opts.bootstrap, opts.seed, opts.jobs)
+        cf_data['bootstrap'] = np.nanpercentile(boot, [16, 84], axis = 0).T.flatten()
+        cf_data['boot_failed'] = np.sum(np.isnan(boot[:, 0]))
+
+    if opts.mcmc:
+        # Sample the posterior of r_s and the background
+        if opts.bg_sigma:
+            bg_prior = (bg_density_ini, opts.bg_sigma)
+        else:
+            bg_prior = None
+        chain, log_post, accept = problem.sample(opts.mcmc, opts.walkers, opts.seed, bg_prior)
+        burn = chain[opts.mcmc // 2:].reshape(-1, chain.shape[2])
+        cf_data['mcmc'] = np.percentile(burn, [16, 50, 84], axis = 0).T.flatten()
+        cf_data['chain'] = {'chain': chain, 'log_post': log_post, 'accept': accept,
+                            'seed': opts.seed, 'bg_prior': np.array(bg_prior or [])}
 
     # Print results 
     print ''
+    if 'binning' in cf_data:
+        print ' Binned - exact likelihood at best fit:', cf_data['binning'][0]
+        print ' Estimated shift of exact best fit: r_s', cf_data['binning'][1], \
+          'bg', cf_data['binning'][2]
     print ' Best-fit r_s:', r_scale_best
     if opts.confidence:
         print ' 1-sigma interval: ', cf_limits[0], cf_limits[1]
+    if 'fisher' in cf_data:
+        print ' Fisher errors: sigma(r_s) =', cf_data['fisher'][0], \
+          'sigma(bg) =', cf_data['fisher'][1], 'corr =', cf_data['fisher'][2]
+        if problem.fit_beta:
+            print ' Fisher errors: sigma(beta) =', cf_data['fisher'][3]
+    if 'bootstrap' in cf_data:
+        print ' Bootstrap 1-sigma interval: ', cf_data['bootstrap'][0], \
+          cf_data['bootstrap'][1], '[' + str(opts.bootstrap), 'resamplings, seed =', \
+          str(opts.seed) + ']'
+        if cf_data['boot_failed']:
+            print ' Bootstrap fits failed for', cf_data['boot_failed'], 'resamplings.'
+    if 'mcmc' in cf_data:
+        print ' MCMC r_s (16, 50, 84 percentiles):', cf_data['mcmc'][0], \
+          cf_data['mcmc'][1], cf_data['mcmc'][2], '[acceptance =', \
+          str(np.mean(cf_data['chain']['accept'])) + ', seed =', str(opts.seed) + ']'
     print ' Best-fit background density:', bg_density_best, 'gals/Mpc^2'
+    if 'bootstrap' in cf_data and fit_bg:
+        print ' Bootstrap 1-sigma interval: ', cf_data['bootstrap'][2], cf_data['bootstrap'][3]
+    if 'mcmc' in cf_data and len(cf_data['mcmc']) > 3:
+        print ' MCMC background (16, 50, 84 percentiles):', cf_data['mcmc'][3], \
+          cf_data['mcmc'][4], cf_data['mcmc'][5]
+    if problem.fit_beta:
+        print ' Best-fit beta:', problem.alpha
     print ''
     print ' Chi^2 of the fit is', chi2_param[0], 'for', len(edp) - npfree, 'd.o.f.'
     print ' Probability of the fit is', chi2_param[1], '[rejected if > 0.99]'
@@ -199,4 +1078,4 @@ def best_fit(opts, R_proj, r_scale_ini, grid, bg_density_ini = 0.0, fit_bg = Tru
     print ' KS test resuls:', ks_param[0], ks_param[1]
     print ' AD test results:', ad_param[0], ad_param[2]
 
-    return [r_scale_best, bg_density_best], [rd, dp, edp], [x_fit, y_fit], chi2_param
+    return best_params, [rd, dp, edp], [x_fit, y_fit], chi2_param, cf_data
@@ -35,6 +35,8 @@ class Global():
     #
     def __init__(self, data):
 
+        astro.check_obj((data.ra, data.dec))
+
         self.mem = data
         self.m_centre = (data.ra.median(), data.dec.median(),
                          data.z.median())
@@ -49,9 +51,12 @@ class Global():
 
         if centre is None:
             centre = self.m_centre
-        
+        else:
+            astro.check_obj(centre)
+
+        # The members have been checked on initialisation.
         d_ang = np.mean(astro.ang_sep((self.mem.ra, self.mem.dec),
-                                      (centre[0], centre[1])))
+                                      (centre[0], centre[1]), check = False))
 
         self.size_arcm = d_ang * 60.0
         self.area_arcm = np.pi * self.size_arcm ** 2
@@ -87,7 +92,7 @@ def xy_centre(data, centre = None,  H0 = 100.0):
         centre = (data.ra.median(), data.dec.median(),
                   data.z.median())
 
-    da = cosmo2.d_angdi(centre[2], *const.BASE) * \
+    da = cosmo2.distance_table(*const.BASE).d_angdi(centre[2]) * \
       cosmo2.d_H(H0)
       
     x = da *astro.deg2rad((centre[0] - data.ra) * \
@@ -133,7 +138,7 @@ def new_r(data, centre, name = None):
 #
 def xy_pos(pos, centre, H0 = 100.0):
 
-    da = cosmo2.d_angdi(centre[2], *const.BASE) * \
+    da = cosmo2.distance_table(*const.BASE).d_angdi(centre[2]) * \
       cosmo2.d_H(H0)
       
     x = da *astro.deg2rad((centre[0] - pos[0]) * \
@@ -121,25 +121,114 @@ def xyz2radec(x, y, z):
 
 # ANGULAR SEPARATION
 
+##
+#  Number of pairs per block of ang_sep_pairs.
+ANG_SEP_BLOCK = 2 ** 20
+
 ##
 #  Function that calculates the angular separation
-#  in degrees between to objects.
+#  in degrees between to objects with the Vincenty
+#  formula, which is accurate at all separations.
+#  The coordinates can be scalars or arrays that
+#  broadcast against each other (e.g. many objects
+#  and one centre).
 #
 #  @param[in] obj1: RA and Dec of object 1 in degrees.
 #  @param[in] obj2: RA and Dec of object 2 in degrees.
+#  @param[in] check: Option to check the RA and Dec
+#  values. Default (check = True).
 #
 #  @return Angular separation in degrees.
 # 
-def ang_sep(obj1, obj2):
+def ang_sep(obj1, obj2, check = True):
 
-    check_obj(obj1)
-    check_obj(obj2)
-    
-    dist = np.around(np.sin(deg2rad(obj1[1])) * np.sin(deg2rad(obj2[1])) + \
-                     np.cos(deg2rad(obj1[1])) * np.cos(deg2rad(obj2[1])) * \
-                     np.cos(deg2rad(obj1[0]) - deg2rad(obj2[0])), 10)
+    if check:
+        check_obj(obj1)
+        check_obj(obj2)
+
+    ra1, dec1 = np.asarray(obj1[0]), np.asarray(obj1[1])
+    ra2, dec2 = np.asarray(obj2[0]), np.asarray(obj2[1])
+
+    # The differences are taken in degrees, where they are exact for
+    # close objects.
+    return rad2deg(vincenty(deg2rad(dec1), deg2rad(dec2), deg2rad(dec2 - dec1),
+                            deg2rad(ra2 - ra1)))
+
+##
+#  Function that calculates the angular
+#  separation in radians with the Vincenty
+#  formula. The terms are written with the
+#  differences in Dec and RA so that there is
+#  no cancellation at small separations.
+#
+#  @param[in] dec1: Dec of object 1 in radians.
+#  @param[in] dec2: Dec of object 2 in radians.
+#  @param[in] d_dec: Difference in Dec in radians.
+#  @param[in] d_ra: Difference in RA in radians.
+#
+#  @return Angular separation in radians.
+#
+def vincenty(dec1, dec2, d_dec, d_ra):
+
+    cos2 = np.cos(dec2)
+    hav_ra = 2.0 * np.sin(0.5 * d_ra) ** 2
+
+    num = np.hypot(cos2 * np.sin(d_ra), np.sin(d_dec) + np.sin(dec1) * cos2 * hav_ra)
+    den = np.cos(d_dec) - np.cos(dec1) * cos2 * hav_ra
+
+    return np.arctan2(num, den)
+
+##
+#  Function that calculates the angular separation
+#  in degrees between all pairs of two sets of
+#  objects. The pairs are calculated in blocks of
+#  rows of about ANG_SEP_BLOCK pairs.
+#
+#  @param[in] obj1: RA and Dec arrays of set 1 in
+#  degrees.
+#  @param[in] obj2: RA and Dec arrays of set 2 in
+#  degrees.
+#  @param[in] max_sep: Optional maximum separation
+#  in degrees.
+#  @param[in] check: Option to check the RA and Dec
+#  values. Default (check = True).
+#
+#  @return Array of separations with shape
+#  (n1, n2) or, if max_sep is given, indices in
+#  sets 1 and 2 and separations of the pairs
+#  within max_sep.
+#
+def ang_sep_pairs(obj1, obj2, max_sep = None, check = True):
+
+    if check:
+        check_obj(obj1)
+        check_obj(obj2)
+
+    ra1, dec1 = np.atleast_1d(obj1[0]), np.atleast_1d(obj1[1])
+    ra2, dec2 = np.atleast_1d(obj2[0]), np.atleast_1d(obj2[1])
+    rad1, rad2 = deg2rad(dec1), deg2rad(dec2)
+
+    n_rows = max(1, ANG_SEP_BLOCK // max(1, len(ra2)))
+
+    if max_sep is None:
+        sep = np.empty((len(ra1), len(ra2)))
+    else:
+        pairs = [(np.empty(0, dtype = 'int'), np.empty(0, dtype = 'int'), np.empty(0))]
+
+    for start in range(0, len(ra1), n_rows):
+        rows = slice(start, start + n_rows)
+        block = rad2deg(vincenty(rad1[rows, None], rad2, deg2rad(dec2 - dec1[rows, None]),
+                                 deg2rad(ra2 - ra1[rows, None])))
+        if max_sep is None:
+            sep[rows] = block
+        else:
+            i, j = np.nonzero(block <= max_sep)
+            pairs.append((i + start, j, block[i, j]))
+
+    if max_sep is None:
+        return sep
 
-    return rad2deg(np.array(np.arccos(dist)))
+    return tuple(np.concatenate(column) for column in zip(*pairs))
     
 # MAGNITUDE/FLUX CONVERSION
 
@@ -14,8 +14,9 @@
 #
 
 import numpy as np
+from scipy.special import hyp2f1
 from library import const
-from functions.extra_math import integ_2arg, vinteg_2arg
+from functions.extra_math import integ_2arg, vinteg_2arg, hermite_coef, hermite_eval
 
 ##
 #  This function checks if the cosmological
@@ -34,6 +35,29 @@ def check_cosmo(z, Omega_M, Omega_L):
                              (np.any(Omega_L < 0.0))):
         raise ValueError('Invalid cosmology!')
 
+##
+#  Curvature below which a cosmology is treated
+#  as flat.
+FLAT_TOL = 1e-12
+
+##
+#  Redshift below which the flat comoving
+#  distance is calculated from its Taylor
+#  series.
+FLAT_Z_SERIES = 1e-4
+
+##
+#  This function checks if a cosmology is flat.
+#
+#  @param[in] Omega_M: Matter density parameter.
+#  @param[in] Omega_L: Dark energy density parameter.
+#
+#  @return True if Omega_K = 0.
+#
+def is_flat(Omega_M, Omega_L):
+
+    return abs(1.0 - Omega_M - Omega_L) < FLAT_TOL
+
 ##
 #  This function calculates the Hubble
 #  time T_H in Gyr.
@@ -70,14 +94,27 @@ def age(H_0, z, Omega_M, Omega_L):
 
     check_cosmo(z, Omega_M, Omega_L)
 
+    # Closed form for flat cosmologies with matter.
+    if is_flat(Omega_M, Omega_L) and Omega_M > 0.0:
+        A = (1.0 + np.asarray(z, dtype = 'float64')) ** -1.5
+        if Omega_L > 0.0:
+            T = np.arcsinh(np.sqrt(Omega_L / Omega_M) * A) / np.sqrt(Omega_L)
+        else:
+            T = A / np.sqrt(Omega_M)
+        return 2.0 / 3.0 * T * t_H(H_0)
+
     def func(z, Omega_M, Omega_L):
         A = 1.0 + z
         B = (1.0 + z) ** 2 * (1.0 + Omega_M * z)
         C = z * (2.0 + z) * Omega_L
         return 1.0 / (A * np.sqrt(B - C))
 
-    return integ_2arg(func, z, np.inf, Omega_M, Omega_L) \
-      * t_H(H_0)
+    if isinstance(z, (list, tuple, np.ndarray)):
+        return vinteg_2arg(func, z, np.inf, Omega_M, Omega_L) * t_H(H_0)
+
+    else:
+        return integ_2arg(func, z, np.inf, Omega_M, Omega_L) \
+          * t_H(H_0)
 
 ##
 #  This function calculates the Hubble distance D_H
@@ -143,12 +180,51 @@ def d_comov(z, Omega_M, Omega_L):
 
     check_cosmo(z, Omega_M, Omega_L)
 
-    if isinstance(z, (list, tuple, np.ndarray)):
+    if is_flat(Omega_M, Omega_L):
+        return d_comov_flat(z, Omega_M, Omega_L)
+
+    elif isinstance(z, (list, tuple, np.ndarray)):
         return vinteg_2arg(E_inv, 0, z, Omega_M, Omega_L)
 
     else:
         return integ_2arg(E_inv, 0, z, Omega_M, Omega_L)
 
+##
+#  This function calculates the line-of-sight comoving
+#  distance D_C of a flat cosmology in closed form.
+#  With x = 1 + z and a = Omega_M / Omega_L, the
+#  integral of 1 / E is x 2F1(1/3, 1/2; 4/3; -a x^3) /
+#  sqrt(Omega_L). Below z = FLAT_Z_SERIES, where the
+#  difference of the two terms loses precision, the
+#  Taylor series to z^3 is used. The relative error is
+#  below 1e-11.
+#
+#  @param[in] z: Redshift.
+#  @param[in] Omega_M: Matter density parameter.
+#  @param[in] Omega_L: Dark energy density parameter.
+#
+#  @return D_C [H0 = c = 1.0].
+#
+def d_comov_flat(z, Omega_M, Omega_L):
+
+    z = np.asarray(z, dtype = 'float64')
+
+    # Einstein-de Sitter, 2 (1 - 1 / sqrt(1 + z)) without cancellation.
+    if Omega_L == 0.0:
+        A = np.sqrt(1.0 + z)
+        return (2.0 * z / (A * (1.0 + A)) / np.sqrt(Omega_M))[()]
+
+    def integ(x):
+        return x * hyp2f1(1.0 / 3.0, 0.5, 4.0 / 3.0, -Omega_M / Omega_L * x ** 3)
+
+    D_C = (integ(1.0 + z) - integ(1.0)) / np.sqrt(Omega_L)
+
+    # Taylor series of D_C with Omega_L = 1 - Omega_M.
+    series = z * (1.0 + z * (-0.75 * Omega_M + z * (1.125 * Omega_M ** 2 -
+                                                    0.5 * Omega_M)))
+
+    return np.where(z < FLAT_Z_SERIES, series, D_C)[()]
+
 ##
 #  This function calculates the proper motion distance
 #  D_M (transverse comoving distance).
@@ -163,10 +239,24 @@ def d_comov(z, Omega_M, Omega_L):
 # 
 def d_prop(z, Omega_M, Omega_L):
 
-    D_M = d_comov(z, Omega_M, Omega_L)
+    return comov_to_prop(d_comov(z, Omega_M, Omega_L), 1.0 - Omega_M - Omega_L)
+
+##
+#  This function converts the line-of-sight
+#  comoving distance D_C to the proper motion
+#  distance D_M.
+#
+#  Equation 16 from H2000.
+#
+#  @param[in] D_C: D_C [H0 = c = 1.0].
+#  @param[in] Omega_K: Curvature density parameter.
+#
+#  @return D_M [H0 = c = 1.0].
+#
+def comov_to_prop(D_C, Omega_K):
+
+    D_M = D_C
 
-    Omega_K = 1.0 - Omega_M - Omega_L
-    
     if Omega_K > 0:
         D_M = np.sinh(np.sqrt(np.abs(Omega_K)) * D_M) / \
           np.sqrt(np.abs(Omega_K))
@@ -209,6 +299,167 @@ def d_lum(z, Omega_M, Omega_L):
     
     return d_prop(z, Omega_M, Omega_L) * (1.0 + z)
 
+##
+#  Default maximum redshift and relative error
+#  bound of the distance tables.
+DIST_TABLE_ZMAX = 20.0
+DIST_TABLE_RTOL = 1e-10
+
+##
+#  Distance tables built in this process, keyed
+#  by cosmology, maximum redshift and error
+#  bound.
+DIST_TABLES = {}
+
+##
+#  Class for interpolating distances. The
+#  comoving distance D_C is tabulated on a grid
+#  uniform in u = ln(1 + z) and interpolated
+#  with cubic Hermite polynomials using the
+#  exact derivative dD_C/du = (1 + z) / E(z).
+#  The table is integrated interval by interval
+#  with 10-point Gauss-Legendre quadrature and
+#  the number of intervals is doubled until the
+#  relative error of D_C at the quarter, half
+#  and three quarter points of every interval
+#  is below rtol. Distances above z_max are
+#  calculated with d_comov.
+class DistanceTable():
+
+    ##
+    #  Initialisation method.
+    #
+    #  @param[in] Omega_M: Matter density parameter.
+    #  @param[in] Omega_L: Dark energy density parameter.
+    #  @param[in] z_max: Maximum redshift of the
+    #  table.
+    #  @param[in] rtol: Relative error bound.
+    #  @param[in] n_init: Initial number of
+    #  intervals.
+    #  @param[in] n_max: Maximum number of
+    #  intervals.
+    #
+    #  @exception ValueError if rtol can not be
+    #  reached.
+    #
+    def __init__(self, Omega_M, Omega_L, z_max = DIST_TABLE_ZMAX,
+                 rtol = DIST_TABLE_RTOL, n_init = 64, n_max = 2 ** 16):
+
+        check_cosmo(z_max, Omega_M, Omega_L)
+
+        self.Omega_M, self.Omega_L = Omega_M, Omega_L
+        self.Omega_K = 1.0 - Omega_M - Omega_L
+        self.z_max = z_max
+
+        x_gl, w_gl = np.polynomial.legendre.leggauss(10)
+        n = n_init
+
+        while True:
+
+            u, self.h = np.linspace(0.0, np.log1p(z_max), n + 1, retstep = True)
+            z = np.expm1(u)
+
+            # Integral of dD_C/du from each node to a fraction of
+            # the next interval.
+            def integ(frac):
+                u_gl = u[:-1, None] + 0.5 * frac * self.h * (x_gl + 1.0)
+                z_gl = np.expm1(u_gl)
+                return 0.5 * frac * self.h * \
+                  np.dot((1.0 + z_gl) * E_inv(z_gl, Omega_M, Omega_L), w_gl)
+
+            d_c = np.append(0.0, np.cumsum(integ(1.0)))
+            self.coef = hermite_coef(d_c, (1.0 + z) * E_inv(z, Omega_M, Omega_L) * self.h)
+
+            index = np.arange(n)
+            self.error = max(np.max(np.abs(hermite_eval(index + frac, self.coef) /
+                                           (d_c[:-1] + integ(frac)) - 1.0))
+                             for frac in (0.25, 0.5, 0.75))
+
+            if self.error <= rtol:
+                break
+
+            n *= 2
+            if n > n_max:
+                raise ValueError('Distance table can not reach rtol = ' + str(rtol) + '.')
+
+    ##
+    #  Line-of-sight comoving distance D_C.
+    #
+    #  @param[in] z: Redshift.
+    #
+    #  @return D_C [H0 = c = 1.0].
+    #
+    def d_comov(self, z):
+
+        check_cosmo(z, self.Omega_M, self.Omega_L)
+
+        z = np.asarray(z, dtype = 'float64')
+        x = np.atleast_1d(z).ravel()
+
+        u = np.log1p(x) * (1.0 / self.h)
+        inside = u < len(self.coef)
+
+        value = hermite_eval(np.where(inside, u, 0.0), self.coef)
+
+        if not np.all(inside):
+            value[~inside] = d_comov(x[~inside], self.Omega_M, self.Omega_L)
+
+        return value.reshape(z.shape)[()]
+
+    ##
+    #  Proper motion distance D_M.
+    #
+    #  @param[in] z: Redshift.
+    #
+    #  @return D_M [H0 = c = 1.0].
+    #
+    def d_prop(self, z):
+
+        return comov_to_prop(self.d_comov(z), self.Omega_K)
+
+    ##
+    #  Angular diameter distance D_A.
+    #
+    #  @param[in] z: Redshift.
+    #
+    #  @return D_A [H0 = c = 1.0].
+    #
+    def d_angdi(self, z):
+
+        return self.d_prop(z) / (1.0 + np.asarray(z))
+
+    ##
+    #  Luminosity distance D_L.
+    #
+    #  @param[in] z: Redshift.
+    #
+    #  @return D_L [H0 = c = 1.0].
+    #
+    def d_lum(self, z):
+
+        return self.d_prop(z) * (1.0 + np.asarray(z))
+
+##
+#  This function returns the distance table for
+#  a given cosmology. Tables are built once per
+#  process.
+#
+#  @param[in] Omega_M: Matter density parameter.
+#  @param[in] Omega_L: Dark energy density parameter.
+#  @param[in] z_max: Maximum redshift of the table.
+#  @param[in] rtol: Relative error bound.
+#
+#  @return DistanceTable instance.
+#
+def distance_table(Omega_M, Omega_L, z_max = DIST_TABLE_ZMAX, rtol = DIST_TABLE_RTOL):
+
+    key = (Omega_M, Omega_L, z_max, rtol)
+
+    if key not in DIST_TABLES:
+        DIST_TABLES[key] = DistanceTable(Omega_M, Omega_L, z_max, rtol)
+
+    return DIST_TABLES[key]
+
 ##
 #  This function calculates the derivative of the proper
 #  motion distance with respect to redshift dD_M/dz.
@@ -277,7 +528,10 @@ def v_comov(z, Omega_M, Omega_L):
     
     V_C = (4.0 * np.pi * D_M ** 3) / 3.0
 
-    if Omega_K < 0:
+    if is_flat(Omega_M, Omega_L):
+        return V_C
+
+    elif Omega_K < 0:
         A = (2.0 * np.pi / Omega_K)
         B = D_M * np.sqrt(1.0 + Omega_K * D_M ** 2)
         C = np.arcsin(np.sqrt(np.abs(Omega_K)) * D_M) / \
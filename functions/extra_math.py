@@ -49,6 +49,50 @@ def vinteg_2arg(func, lim_low, lim_up, arg1, arg2):
     
     return v_integ(func, lim_low, lim_up, arg1, arg2)
 
+##
+#  Function calculates the coefficients of the
+#  cubic Hermite polynomials between the nodes
+#  of a uniform grid.
+#
+#  @param[in] y: Values at the nodes.
+#  @param[in] dy: Derivatives at the nodes
+#  times the grid spacing.
+#
+#  @return Array of coefficients with shape
+#  (n_intervals, 4), lowest order first.
+#
+def hermite_coef(y, dy):
+
+    return np.column_stack([y[:-1], dy[:-1], 3.0 * (y[1:] - y[:-1]) - 2.0 * dy[:-1] - dy[1:],
+                            2.0 * (y[:-1] - y[1:]) + dy[:-1] + dy[1:]])
+
+##
+#  Function evaluates cubic Hermite polynomials
+#  on a uniform grid.
+#
+#  @param[in] u: Positions in units of the grid
+#  spacing from the first node. Must be in the
+#  range [0, n_intervals).
+#  @param[in] coef: Coefficients from
+#  hermite_coef.
+#
+#  @return Interpolated values.
+#
+def hermite_eval(u, coef):
+
+    index = u.astype(np.intp)
+    u = u - index
+    c = coef.take(index, axis = 0)
+
+    value = c[:, 3] * u
+    value += c[:, 2]
+    value *= u
+    value += c[:, 1]
+    value *= u
+    value += c[:, 0]
+
+    return value
+
 ##
 #  Function that returns k-values in the
 #  range L.
@@ -0,0 +1,83 @@
+## @file mcmc.py
+#
+#  MCMC FUNCTIONS
+#
+#  Affine-invariant ensemble sampler
+#  (Goodman & Weare 2010, stretch move).
+#
+#  @author Samuel Farrens
+#  @version 1.0
+#  @date 2015
+#
+
+import numpy as np
+
+##
+#  Function that samples a log-probability
+#  with an ensemble of walkers. The walkers
+#  are split into two halves that are moved
+#  in turn against the other half, so each
+#  update makes one call to log_prob with all
+#  the walkers of a half.
+#
+#  @param[in] log_prob: Function of an array of
+#  walker positions with shape (n_walkers, n_dim)
+#  returning an array of log-probabilities
+#  (-inf outside the prior).
+#  @param[in] p_ini: Initial walker positions.
+#  @param[in] n_steps: Number of steps.
+#  @param[in] stretch: Stretch scale parameter.
+#  Default (stretch = 2.0).
+#  @param[in] rng: Optional numpy RandomState.
+#
+#  @return Chain with shape (n_steps, n_walkers,
+#  n_dim), log-probabilities with shape (n_steps,
+#  n_walkers) and acceptance fraction of each
+#  walker.
+#
+#  @exception ValueError for too few walkers or
+#  invalid initial positions.
+#
+def ensemble_sampler(log_prob, p_ini, n_steps, stretch = 2.0, rng = None):
+
+    if rng is None:
+        rng = np.random.RandomState()
+
+    pos = np.array(p_ini, dtype = 'float64')
+    n_walk, n_dim = pos.shape
+
+    if n_walk < 2 * n_dim or n_walk % 2:
+        raise ValueError('The number of walkers must be even and >= 2 * n_dim.')
+
+    lp = log_prob(pos)
+    if not np.all(np.isfinite(lp)):
+        raise ValueError('Initial walker positions must have finite probability.')
+
+    chain = np.empty((n_steps, n_walk, n_dim))
+    lp_chain = np.empty((n_steps, n_walk))
+    n_accept = np.zeros(n_walk)
+
+    halves = (np.arange(0, n_walk, 2), np.arange(1, n_walk, 2))
+
+    for step in range(n_steps):
+
+        for move, other in (halves, halves[::-1]):
+
+            # Stretch each walker towards or away from a random
+            # walker of the other half.
+            z = ((stretch - 1.0) * rng.rand(move.size) + 1.0) ** 2 / stretch
+            partner = pos[other[rng.randint(0, other.size, move.size)]]
+            prop = partner + z[:, None] * (pos[move] - partner)
+
+            lp_prop = log_prob(prop)
+            accept = (n_dim - 1.0) * np.log(z) + lp_prop - lp[move] > \
+              np.log(rng.rand(move.size))
+
+            pos[move[accept]] = prop[accept]
+            lp[move[accept]] = lp_prop[accept]
+            n_accept[move[accept]] += 1
+
+        chain[step] = pos
+        lp_chain[step] = lp
+
+    return chain, lp_chain, n_accept / n_steps
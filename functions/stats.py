@@ -10,7 +10,13 @@
 #
 
 import numpy as np
-import scipy.stats as ss
+import scipy.special as sp
+from collections import OrderedDict
+
+##
+#  Maximum number of degrees of freedom kept
+#  in a quantile cache.
+QUANTILE_CACHE_SIZE = 1024
 
 ##
 #  Function that tests the chi^2 goodness
@@ -31,6 +37,64 @@ import scipy.stats as ss
 def chi2_gof(data_obs, data_exp, sigma, ddof = 1):
 
     chi2 = np.sum(((data_obs - data_exp) / sigma) ** 2)
-    p_val = ss.chi2.cdf(chi2, len(data_obs) - ddof)
+    p_val = sp.chdtr(len(data_obs) - ddof, chi2)
 
     return chi2, p_val
+
+##
+#  Class for caching the chi^2 and Student's t
+#  quantiles of the biweight confidence bounds
+#  by degrees of freedom. The quantiles are
+#  computed with the special functions that
+#  scipy.stats uses, so they are identical to
+#  chi2.ppf, chi2.isf and t.isf. The least
+#  recently used degrees of freedom are dropped
+#  when the cache is full.
+class QuantileCache():
+
+    ##
+    #  Initialisation method.
+    #
+    #  @param[in] q: Tail probability.
+    #  @param[in] size: Maximum number of cached
+    #  degrees of freedom.
+    #
+    def __init__(self, q, size = QUANTILE_CACHE_SIZE):
+
+        self.q = q
+        self.size = size
+        self.cache = OrderedDict()
+
+    ##
+    #  Get the quantiles.
+    #
+    #  @param[in] dof: Degrees of freedom (scalar
+    #  or array).
+    #
+    #  @return chi2.ppf(q, dof), chi2.isf(q, dof)
+    #  and t.isf(q, dof).
+    #
+    def get(self, dof):
+
+        dof = np.asarray(dof, dtype = 'float64')
+        keys, inverse = np.unique(dof, return_inverse = True)
+
+        missing = np.array([key for key in keys if key not in self.cache])
+        if missing.size:
+            values = np.column_stack([sp.chdtri(missing, 1.0 - self.q),
+                                      sp.chdtri(missing, self.q),
+                                      -sp.stdtrit(missing, self.q)])
+            self.cache.update(zip(missing, values))
+
+        # Move the requested values to the most recently used end.
+        values = np.array([self.cache.pop(key) for key in keys])
+        self.cache.update(zip(keys, values))
+        while len(self.cache) > self.size:
+            self.cache.popitem(last = False)
+
+        return [values[inverse, i].reshape(dof.shape)[()] for i in range(3)]
+
+##
+#  Cache of the quantiles of the 68% confidence
+#  bounds.
+QUANTILES_68 = QuantileCache(0.32 / 2.0)
@@ -13,6 +13,7 @@
 
 import numpy as np
 from functools import partial
+from halo_methods.maxlik import proj_num_density, proj_maxlik, proj_maxlik_derivs
 
 ##
 #  Function calculates the beta model 
@@ -25,6 +26,25 @@ def bm_proj_sd(t, alpha):
     return 1.0 / (1.0 + t ** 2) ** alpha
     
 
+##
+#  Function calculates the first and second
+#  derivatives of the beta model projected
+#  surface density with respect to t.
+#
+#  @param[in] t: t = R / r_s.
+#
+#  @return dS/dt and d^2S/dt^2.
+#
+def bm_proj_sd_deriv(t, alpha):
+
+    q = 1.0 + t ** 2
+    sd = bm_proj_sd(t, alpha)
+
+    sd_d1 = -2.0 * alpha * t * sd / q
+    sd_d2 = -2.0 * alpha * sd / q * (1.0 - 2.0 * (alpha + 1.0) * t ** 2 / q)
+
+    return sd_d1, sd_d2
+
 ##
 #  Function calculates the beta model
 #  projected mass along a cylinder in
@@ -42,6 +62,38 @@ def bm_proj_mass(t, alpha):
 
     return mp
 
+##
+#  Function calculates the difference of
+#  the beta model projected mass between
+#  two radii from their log terms log(1 + t^2).
+#  This form is continuous through alpha = 1.
+#
+#  @param[in] l_low: Log term of lower radius.
+#  @param[in] l_up: Log term of upper radius.
+#  @param[in] alpha: Beta model coefficient.
+#
+def bm_proj_mass_diff(l_low, l_up, alpha):
+
+    k = 1.0 - np.asarray(alpha, dtype = 'float64')
+    k_safe = np.where(k == 0.0, 1.0, k)
+
+    mp_diff = np.exp(k * l_low) * np.expm1(k * (l_up - l_low)) / k_safe
+
+    return np.where(k == 0.0, l_up - l_low, mp_diff)[()]
+
+##
+#  Function calculates the difference of
+#  the beta model projected mass between
+#  two values of t.
+#
+#  @param[in] t_low: Lower value of t.
+#  @param[in] t_up: Upper value of t.
+#  @param[in] alpha: Beta model coefficient.
+#
+def bm_proj_mass_range(t_low, t_up, alpha):
+
+    return bm_proj_mass_diff(np.log1p(t_low ** 2), np.log1p(t_up ** 2), alpha)
+
 ##
 #  Beta model number density for given 
 #  projected radius, scale radius and 
@@ -50,19 +102,42 @@ def bm_proj_mass(t, alpha):
 #  @param[in] R_proj: Projected radius.
 #  @param[in] r_scale: Scale radius.
 #  @param[in] bg_density: Background density.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
 #
-def bm_num_density(R_proj, r_scale, bg_density, alpha):
+def bm_num_density(R_proj, r_scale, bg_density, alpha, R_lim = None, n_mem = None):
 
-    t_up = max(R_proj) / r_scale
-    t_low = min(R_proj) / r_scale
+    if R_lim is None:
+        R_lim = (np.min(R_proj), np.max(R_proj))
 
-    bm_num = len(R_proj) - np.pi * r_scale ** 2 * (t_up ** 2 - t_low ** 2) * bg_density
-    bm_den = np.pi * r_scale ** 2 * (bm_proj_mass(t_up, alpha) - bm_proj_mass(t_low, alpha))
+    if n_mem is None:
+        n_mem = len(R_proj)
 
-    if bm_num <= 0:
-        bm_num = 0.1
-    
-    return bm_num / bm_den
+    return proj_num_density(r_scale, bg_density, R_lim, n_mem,
+                            partial(bm_proj_mass_range, alpha = alpha))
+
+##
+#  Maximum liklihood for projected beta
+#  model with background and a given
+#  coefficient.
+#
+#  @param[in] r_scale: Scale radius.
+#  @param[in] bg_density: Background density.
+#  @param[in] alpha: Beta model coefficient.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#
+def bm_maxlik(r_scale, bg_density, alpha, R_proj, weights = None, R_lim = None,
+              n_mem = None):
+
+    return proj_maxlik((r_scale, bg_density), R_proj, partial(bm_proj_sd, alpha = alpha),
+                       partial(bm_proj_mass_range, alpha = alpha), weights, R_lim, n_mem)
 
 ##
 #  Maximum liklihood for projected beta
@@ -71,19 +146,86 @@ def bm_num_density(R_proj, r_scale, bg_density, alpha):
 #  @param[in] r_scale_bg: Scale radius
 #  and background density.
 #  @param[in] R_proj: Projected radius.
+#  @param[in] alpha: Beta model coefficient.
 #  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
 #
-def bm_proj_maxlik_bg(r_scale_bg, R_proj, alpha, weights = None):
-    
-    bm_sd = np.array(map(partial(bm_proj_sd, alpha = alpha),
-                         R_proj / r_scale_bg[0]))
+def bm_proj_maxlik_bg(r_scale_bg, R_proj, alpha, weights = None, R_lim = None,
+                      n_mem = None):
 
-    bm_nden = bm_num_density(R_proj, r_scale_bg[0], r_scale_bg[1], alpha)
-    
-    prob = bm_nden * bm_sd + r_scale_bg[1]
+    return bm_maxlik(r_scale_bg[0], r_scale_bg[1], alpha, R_proj, weights, R_lim, n_mem)
+
+##
+#  Maximum liklihood for projected beta
+#  model with background and a free
+#  coefficient.
+#
+#  @param[in] r_scale_bg_alpha: Scale radius,
+#  background density and beta model
+#  coefficient.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#
+def bm_proj_maxlik_bg_beta(r_scale_bg_alpha, R_proj, weights = None, R_lim = None,
+                           n_mem = None):
 
-    if weights is None:
-        return np.sum(-np.log(prob))
+    return bm_maxlik(r_scale_bg_alpha[0], r_scale_bg_alpha[1], r_scale_bg_alpha[2],
+                     R_proj, weights, R_lim, n_mem)
 
-    else:
-        return np.sum(-np.log(prob) * weights)
+##
+#  Gradient of the maximum liklihood for
+#  projected beta model with background.
+#
+#  @param[in] r_scale_bg: Scale radius
+#  and background density.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] alpha: Beta model coefficient.
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#
+#  @return Derivatives with respect to
+#  scale radius and background density.
+#
+def bm_proj_maxlik_bg_grad(r_scale_bg, R_proj, alpha, weights = None, R_lim = None,
+                           n_mem = None):
+
+    return proj_maxlik_derivs(r_scale_bg, R_proj, partial(bm_proj_sd, alpha = alpha),
+                              partial(bm_proj_sd_deriv, alpha = alpha),
+                              partial(bm_proj_mass_range, alpha = alpha), weights,
+                              R_lim, n_mem)
+
+##
+#  Hessian of the maximum liklihood for
+#  projected beta model with background.
+#
+#  @param[in] r_scale_bg: Scale radius
+#  and background density.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] alpha: Beta model coefficient.
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#
+#  @return 2x2 matrix of second derivatives
+#  with respect to scale radius and
+#  background density.
+#
+def bm_proj_maxlik_bg_hess(r_scale_bg, R_proj, alpha, weights = None, R_lim = None,
+                           n_mem = None):
+
+    return proj_maxlik_derivs(r_scale_bg, R_proj, partial(bm_proj_sd, alpha = alpha),
+                              partial(bm_proj_sd_deriv, alpha = alpha),
+                              partial(bm_proj_mass_range, alpha = alpha), weights,
+                              R_lim, n_mem, hessian = True)[1]
@@ -0,0 +1,221 @@
+## @file maxlik.py
+#
+#  PROJECTED LIKELIHOOD DERIVATIVES
+#
+#  Functions for calculating the gradient and
+#  Hessian of the projected profile likelihoods
+#  with respect to the scale radius and the
+#  background density.
+#
+#  The likelihood is L = -sum(w * log(p)) with
+#  p = n(r_s, bg) * S(R / r_s) + bg, where S is
+#  the projected surface density and n is the
+#  number density normalisation. The projected
+#  mass G of every profile satisfies
+#  dG/dt = 2 * t * S(t).
+#
+#  All functions broadcast over leading axes:
+#  the parameters may be arrays of shape (B,)
+#  with projected radii of shape (B, N), e.g.
+#  for bootstrap replicates.
+#
+#  @author Samuel Farrens
+#  @version 1.0
+#  @date 2015
+#
+
+import numpy as np
+
+##
+#  Function calculates the number density
+#  normalisation n = (n_mem - area * bg) /
+#  (pi * r_s^2 * (G(t_up) - G(t_low))). The
+#  numerator is floored at 0.1.
+#
+#  @param[in] r_scale: Scale radius.
+#  @param[in] bg_density: Background density.
+#  @param[in] R_lim: Minimum and maximum
+#  projected radius.
+#  @param[in] n_mem: Number of members.
+#  @param[in] mass_diff: Function returning
+#  G(t_up) - G(t_low).
+#
+#  @return Number density normalisation.
+#
+def proj_num_density(r_scale, bg_density, R_lim, n_mem, mass_diff):
+
+    area = np.pi * (R_lim[1] ** 2 - R_lim[0] ** 2)
+    num = n_mem - area * bg_density
+    num = np.where(num <= 0, 0.1, num)
+
+    return num / (np.pi * r_scale ** 2 * mass_diff(R_lim[0] / r_scale, R_lim[1] / r_scale))
+
+##
+#  Function calculates the number density
+#  normalisation and its derivatives with
+#  respect to the scale radius (r) and the
+#  background density (b).
+#
+#  @param[in] r_scale: Scale radius.
+#  @param[in] bg_density: Background density.
+#  @param[in] R_lim: Minimum and maximum
+#  projected radius.
+#  @param[in] n_mem: Number of members.
+#  @param[in] sd_func: Surface density S(t).
+#  @param[in] sd_deriv: Function returning
+#  dS/dt and d^2S/dt^2.
+#  @param[in] mass_diff: Function returning
+#  G(t_up) - G(t_low).
+#
+#  @return n, dn/dr, dn/db, d^2n/dr^2 and
+#  d^2n/drdb.
+#
+def num_density_derivs(r_scale, bg_density, R_lim, n_mem, sd_func, sd_deriv,
+                       mass_diff):
+
+    t = np.array([R_lim[0] / r_scale, R_lim[1] / r_scale])
+    sd = sd_func(t)
+    sd_d1 = sd_deriv(t)[0]
+
+    # Differences between the upper and lower limit of G, t * G'
+    # and t^2 * G''.
+    d_mass = mass_diff(t[0], t[1])
+    tg1 = 2.0 * t ** 2 * sd
+    t2g2 = t ** 2 * (2.0 * sd + 2.0 * t * sd_d1)
+    d_tg1 = tg1[1] - tg1[0]
+    d_t2g2 = t2g2[1] - t2g2[0]
+
+    area = np.pi * (R_lim[1] ** 2 - R_lim[0] ** 2)
+    num = n_mem - area * bg_density
+    num_b = np.where(num <= 0, 0.0, -area)
+    num = np.where(num <= 0, 0.1, num)
+
+    den = np.pi * r_scale ** 2 * d_mass
+    den_r = np.pi * r_scale * (2.0 * d_mass - d_tg1)
+    den_rr = np.pi * (2.0 * d_mass - 2.0 * d_tg1 + d_t2g2)
+
+    n = num / den
+    n_b = num_b / den
+    n_r = -n * den_r / den
+    n_rr = n * (2.0 * (den_r / den) ** 2 - den_rr / den)
+    n_rb = -n_b * den_r / den
+
+    return n, n_r, n_b, n_rr, n_rb
+
+##
+#  Function calculates the projected
+#  likelihood with background.
+#
+#  @param[in] r_scale_bg: Scale radius
+#  and background density.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] sd_func: Surface density S(t).
+#  @param[in] mass_diff: Function returning
+#  G(t_up) - G(t_low).
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#  @param[in] sd: Optional precomputed surface
+#  density S(R_proj / r_scale).
+#
+#  @return Negative log-likelihood.
+#
+def proj_maxlik(r_scale_bg, R_proj, sd_func, mass_diff, weights = None, R_lim = None,
+                n_mem = None, sd = None):
+
+    r_scale = np.asarray(r_scale_bg[0], dtype = 'float64')
+    bg_density = np.asarray(r_scale_bg[1], dtype = 'float64')
+
+    if R_lim is None:
+        R_lim = (np.min(R_proj, axis = -1), np.max(R_proj, axis = -1))
+
+    if n_mem is None:
+        n_mem = R_proj.shape[-1]
+
+    if sd is None:
+        sd = sd_func(R_proj / r_scale[..., None])
+
+    n = proj_num_density(r_scale, bg_density, R_lim, n_mem, mass_diff)
+
+    prob = n[..., None] * sd + bg_density[..., None]
+
+    if weights is None:
+        return -np.sum(np.log(prob), axis = -1)
+
+    else:
+        return -np.sum(np.log(prob) * weights, axis = -1)
+
+##
+#  Function calculates the gradient and,
+#  optionally, the Hessian of the projected
+#  likelihood with background.
+#
+#  @param[in] r_scale_bg: Scale radius
+#  and background density.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] sd_func: Surface density S(t).
+#  @param[in] sd_deriv: Function returning
+#  dS/dt and d^2S/dt^2.
+#  @param[in] mass_diff: Function returning
+#  G(t_up) - G(t_low).
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#  @param[in] hessian: Option to also return
+#  the Hessian.
+#
+#  @return Gradient [and Hessian] with
+#  respect to scale radius and background.
+#
+def proj_maxlik_derivs(r_scale_bg, R_proj, sd_func, sd_deriv, mass_diff,
+                       weights = None, R_lim = None, n_mem = None, hessian = False):
+
+    r_scale = np.asarray(r_scale_bg[0], dtype = 'float64')
+    bg_density = np.asarray(r_scale_bg[1], dtype = 'float64')
+
+    if R_lim is None:
+        R_lim = (np.min(R_proj, axis = -1), np.max(R_proj, axis = -1))
+
+    if n_mem is None:
+        n_mem = R_proj.shape[-1]
+
+    nden = num_density_derivs(r_scale, bg_density, R_lim, n_mem,
+                              sd_func, sd_deriv, mass_diff)
+
+    # Add a member axis to the per-parameter quantities.
+    n, n_r, n_b, n_rr, n_rb = [x[..., None] for x in nden]
+    r_scale, bg_density = r_scale[..., None], bg_density[..., None]
+
+    t = R_proj / r_scale
+    sd = sd_func(t)
+    sd_d1, sd_d2 = sd_deriv(t)
+
+    prob = n * sd + bg_density
+    prob_r = n_r * sd - n * sd_d1 * t / r_scale
+    prob_b = n_b * sd + 1.0
+
+    if weights is None:
+        w_p = 1.0 / prob
+    else:
+        w_p = weights / prob
+
+    grad = -np.array([np.sum(w_p * prob_r, axis = -1), np.sum(w_p * prob_b, axis = -1)])
+
+    if not hessian:
+        return grad
+
+    prob_rr = n_rr * sd - 2.0 * n_r * sd_d1 * t / r_scale + \
+      n * (sd_d2 * t ** 2 + 2.0 * sd_d1 * t) / r_scale ** 2
+    prob_rb = n_rb * sd - n_b * sd_d1 * t / r_scale
+
+    w_p2 = w_p / prob
+
+    h_rr = np.sum(w_p2 * prob_r ** 2 - w_p * prob_rr, axis = -1)
+    h_rb = np.sum(w_p2 * prob_r * prob_b - w_p * prob_rb, axis = -1)
+    h_bb = np.sum(w_p2 * prob_b ** 2, axis = -1)
+
+    return grad, np.array([[h_rr, h_rb], [h_rb, h_bb]])
@@ -16,60 +16,403 @@
 #  @date 2015
 #
 
+import os
+import tempfile
+from stat import S_ISDIR, S_IWGRP, S_IWOTH
 import numpy as np
+from halo_methods.maxlik import proj_num_density, proj_maxlik, proj_maxlik_derivs
+from functions.extra_math import hermite_coef, hermite_eval
+
+##
+#  Half-width of the band around t = 1 in
+#  which the series expansions are used.
+T_SERIES = 1e-2
+
+##
+#  Taylor coefficients of the un-normalised
+#  surface density about t = 1 (highest order
+#  first, for np.polyval).
+SD_SERIES = (6223.0 / 46189.0, -1896.0 / 12155.0, 1181.0 / 6435.0,
+             -94.0 / 429.0, 61.0 / 231.0, -20.0 / 63.0, 13.0 / 35.0,
+             -2.0 / 5.0, 1.0 / 3.0)
+
+##
+#  Taylor coefficients of the un-normalised
+#  projected mass about t = 1 (highest order
+#  first, for np.polyval).
+MASS_SERIES = (3013.0 / 875160.0, -229.0 / 45045.0, 15.0 / 2002.0,
+               -37.0 / 3465.0, 17.0 / 1260.0, -1.0 / 105.0, -1.0 / 30.0,
+               1.0 / 3.0, 1.0 - np.log(2.0))
+
+##
+#  Function returns the masks for the
+#  t < 1, t ~ 1 and t > 1 branches of the
+#  NFW projected functions. Values with
+#  t ~ 0 belong to none of the branches.
+#
+#  @param[in] t: t = R / r_s.
+#
+#  @return Masks for t < 1, t ~ 1 and t > 1.
+#
+def nfw_branches(t):
+
+    mid = np.abs(t - 1.0) <= T_SERIES
+    low = (np.around(t, 8) > 0.0) & (t < 1.0) & ~mid
+    high = (t > 1.0) & ~mid
+
+    return low, mid, high
 
 ##
 #  Function calculates the NFW profile
 #  projected surface density.
 #
-#  Equations 42 and 43 from LM2001.
+#  Equations 42 and 43 from LM2001. Accepts
+#  scalars or arrays of any shape. A Taylor
+#  series is used for |t - 1| <= T_SERIES
+#  where the closed form suffers from
+#  cancellation.
 #
 #  @param[in] t: t = R / r_s.
 #
 def nfw_proj_sd(t):
 
-    if np.around(t, 8) == 0.0:
-        sd = 0.0
-        
-    elif 1.0 - np.around(t, 8) == 0.0:
-        sd = 1.0 / 3.0
-        
-    else:
-        cm1 = 1.0
-        if t < 1:
-                cm1 = np.arccosh(1.0 / t)
-        elif t > 1:
-                cm1 = np.arccos(1.0 / t)
-        sd = (1.0 - cm1 / np.sqrt(np.abs(t ** 2 - 1.0))) / (t ** 2 - 1.0)
-    
-    return sd / (2.0 * np.log(2.0) - 1.0)
+    t = np.asarray(t, dtype = 'float64')
+    x = np.atleast_1d(t)
+    sd = np.zeros(x.shape)
+
+    low, mid, high = nfw_branches(x)
+
+    x_low = x[low]
+    sd[low] = (1.0 - np.arccosh(1.0 / x_low) / np.sqrt(1.0 - x_low ** 2)) / \
+      (x_low ** 2 - 1.0)
+
+    x_high = x[high]
+    sd[high] = (1.0 - np.arccos(1.0 / x_high) / np.sqrt(x_high ** 2 - 1.0)) / \
+      (x_high ** 2 - 1.0)
+
+    sd[mid] = np.polyval(SD_SERIES, x[mid] - 1.0)
+
+    return (sd / (2.0 * np.log(2.0) - 1.0)).reshape(t.shape)[()]
+
+##
+#  Function calculates the first and second
+#  derivatives of the NFW profile projected
+#  surface density with respect to t.
+#
+#  Obtained by differentiating Equations 42
+#  and 43 from LM2001, which gives
+#  S' = (1 - 3 t^2 S) / (t (t^2 - 1)) and
+#  S'' = -(1 / t^2 + 3 S + 5 t S') / (t^2 - 1)
+#  for the un-normalised S.
+#
+#  @param[in] t: t = R / r_s.
+#
+#  @return dS/dt and d^2S/dt^2.
+#
+def nfw_proj_sd_deriv(t):
+
+    t = np.asarray(t, dtype = 'float64')
+    x = np.atleast_1d(t)
+    sd_d1 = np.zeros(x.shape)
+    sd_d2 = np.zeros(x.shape)
+
+    low, mid, high = nfw_branches(x)
+    out = low | high
+
+    x_out = x[out]
+    sd = nfw_proj_sd(x_out) * (2.0 * np.log(2.0) - 1.0)
+    sd_d1[out] = (1.0 - 3.0 * x_out ** 2 * sd) / (x_out * (x_out ** 2 - 1.0))
+    sd_d2[out] = -(1.0 / x_out ** 2 + 3.0 * sd + 5.0 * x_out * sd_d1[out]) / \
+      (x_out ** 2 - 1.0)
+
+    sd_d1[mid] = np.polyval(np.polyder(SD_SERIES), x[mid] - 1.0)
+    sd_d2[mid] = np.polyval(np.polyder(SD_SERIES, 2), x[mid] - 1.0)
+
+    norm = 2.0 * np.log(2.0) - 1.0
+
+    return (sd_d1 / norm).reshape(t.shape)[()], (sd_d2 / norm).reshape(t.shape)[()]
 
 ##
 #  Function calculates the NFW profile
 #  projected mass along a cylinder in
 #  units of M(r-2).
 #
-#  Equation B1 from MBB2013.
+#  Equation B1 from MBB2013. Accepts scalars
+#  or arrays of any shape. A Taylor series
+#  is used for |t - 1| <= T_SERIES.
 #
 #  @param[in] t: t = R / r_s.
 #
 def nfw_proj_mass(t):
 
-    if np.around(t, 8) == 0.0:
-        mp = 0.0
+    t = np.asarray(t, dtype = 'float64')
+    x = np.atleast_1d(t)
+    mp = np.zeros(x.shape)
+
+    low, mid, high = nfw_branches(x)
+
+    x_low = x[low]
+    mp[low] = np.arccosh(1.0 / x_low) / np.sqrt(1.0 - x_low ** 2) + \
+      np.log(x_low / 2.0)
 
-    elif 1.0 - np.around(t, 8) == 0.0:
-        mp = 1.0 - np.log(2.0)
-        
-    else:
-        capc = 1.0
-        if t > 1:
-            capc = np.arccos(1.0 / t)
-        elif t < 1:
-            capc = np.arccosh(1.0 / t)
-        mp = capc / np.sqrt(np.abs(t ** 2 - 1.0)) + np.log(t / 2.0)
+    x_high = x[high]
+    mp[high] = np.arccos(1.0 / x_high) / np.sqrt(x_high ** 2 - 1.0) + \
+      np.log(x_high / 2.0)
 
-    return mp / (np.log(2.0) - 0.5)
+    mp[mid] = np.polyval(MASS_SERIES, x[mid] - 1.0)
+
+    return (mp / (np.log(2.0) - 0.5)).reshape(t.shape)[()]
+
+##
+#  Function calculates the difference of
+#  the NFW profile projected mass between
+#  two values of t.
+#
+#  @param[in] t_low: Lower value of t.
+#  @param[in] t_up: Upper value of t.
+#
+def nfw_proj_mass_diff(t_low, t_up):
+
+    mp_low, mp_up = nfw_proj_mass(np.array([t_low, t_up]))
+
+    return mp_up - mp_low
+
+##
+#  Default range of t and relative error bound
+#  of the NFW lookup tables. Below t ~ 1e-3 the
+#  closed form of the projected mass itself
+#  loses precision.
+NFW_TABLE_RANGE = (1e-3, 1e4)
+NFW_TABLE_RTOL = 1e-6
+
+##
+#  Version of the cached tables. Must be changed
+#  if the functions tabulated change.
+NFW_TABLE_VERSION = 2
+
+##
+#  Lookup tables loaded in this process, keyed
+#  by range and error bound.
+NFW_TABLES = {}
+
+##
+#  Function evaluates a lookup table. Values of
+#  t outside the table are calculated with the
+#  exact function.
+#
+#  @param[in] t: t = R / r_s.
+#  @param[in] table: Lookup table.
+#  @param[in] name: Name of the tabulated
+#  function (sd or mass).
+#  @param[in] exact_func: Exact function.
+#
+def nfw_table_interp(t, table, name, exact_func):
+
+    t = np.asarray(t, dtype = 'float64')
+    x = np.atleast_1d(t).ravel()
+    coef = table[name]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        u = (np.log(x) - table['u_low']) * (1.0 / table['h'])
+    inside = (u >= 0) & (u < len(coef))
+
+    value = hermite_eval(np.where(inside, u, 0.0), coef)
+
+    if not np.all(inside):
+        value[~inside] = exact_func(x[~inside])
+
+    return value.reshape(t.shape)[()]
+
+##
+#  Function builds lookup tables of the NFW
+#  profile projected surface density and mass.
+#  Both are interpolated with cubic Hermite
+#  polynomials in log(t) using the analytic
+#  derivatives. The number of intervals is
+#  doubled until the relative error at the
+#  quarter, half and three quarter points of
+#  every interval is below rtol.
+#
+#  @param[in] t_range: Range of t.
+#  @param[in] rtol: Relative error bound.
+#  @param[in] n_init: Initial number of
+#  intervals.
+#  @param[in] n_max: Maximum number of
+#  intervals.
+#
+#  @return Lookup table.
+#
+#  @exception ValueError if rtol can not be
+#  reached.
+#
+def nfw_build_table(t_range, rtol, n_init = 256, n_max = 2 ** 16):
+
+    u_lim = np.log(t_range)
+    n = n_init
+
+    while True:
+
+        u, h = np.linspace(u_lim[0], u_lim[1], n + 1, retstep = True)
+        t = np.exp(u)
+        sd = nfw_proj_sd(t)
+
+        # dS/du = t * dS/dt and dG/du = 2 * t^2 * S.
+        table = {'u_low': u_lim[0], 'h': h,
+                 'sd': hermite_coef(sd, t * nfw_proj_sd_deriv(t)[0] * h),
+                 'mass': hermite_coef(nfw_proj_mass(t), 2.0 * t ** 2 * sd * h)}
+
+        t_check = np.exp(u[:-1] + h * np.array([[0.25], [0.5], [0.75]])).ravel()
+        error = max(np.max(np.abs(nfw_table_interp(t_check, table, 'sd', nfw_proj_sd) /
+                                  nfw_proj_sd(t_check) - 1.0)),
+                    np.max(np.abs(nfw_table_interp(t_check, table, 'mass', nfw_proj_mass) /
+                                  nfw_proj_mass(t_check) - 1.0)))
+
+        if error <= rtol:
+            table['error'] = error
+            return table
+
+        n *= 2
+        if n > n_max:
+            raise ValueError('NFW table can not reach rtol = ' + str(rtol) + '.')
+
+##
+#  Function returns the NFW lookup table cache
+#  directory. The directory is created with
+#  mode 0700 and is only used if it is a real
+#  directory owned by the user that can not be
+#  written by others.
+#
+#  @param[in] cache_dir: Cache directory or
+#  None for the per-user default in the system
+#  temporary directory.
+#
+#  @return Cache directory or None if it can not
+#  be used.
+#
+def nfw_cache_dir(cache_dir = None):
+
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'halo_methods-%d' % os.getuid())
+
+    try:
+        if not os.path.lexists(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        stat = os.lstat(cache_dir)
+
+    except OSError:
+        return None
+
+    if (not S_ISDIR(stat.st_mode) or stat.st_uid != os.getuid() or
+        stat.st_mode & (S_IWGRP | S_IWOTH)):
+        return None
+
+    return cache_dir
+
+##
+#  Function returns the NFW lookup tables for
+#  a given range and error bound. The tables
+#  are built once per process and cached on
+#  disk. Cached tables are read without pickles
+#  and only used if their range and error bound
+#  match.
+#
+#  @param[in] t_range: Range of t.
+#  @param[in] rtol: Relative error bound.
+#  @param[in] cache_dir: Optional cache
+#  directory. Default (per-user directory in
+#  the system temporary directory).
+#
+#  @return Lookup table.
+#
+def nfw_table(t_range = NFW_TABLE_RANGE, rtol = NFW_TABLE_RTOL, cache_dir = None):
+
+    key = (t_range[0], t_range[1], rtol)
+
+    if key in NFW_TABLES:
+        return NFW_TABLES[key]
+
+    cache_dir = nfw_cache_dir(cache_dir)
+    file_name = cache_dir and os.path.join(cache_dir, 'nfw_table_v%d_%g_%g_%g.npz' %
+                                           ((NFW_TABLE_VERSION,) + key))
+
+    table = None
+
+    if file_name and os.path.isfile(file_name):
+        try:
+            with np.load(file_name, allow_pickle = False) as data:
+                if (np.array_equal(data['t_range'], t_range) and
+                    float(data['rtol']) == rtol):
+                    table = dict((name, data[name]) for name in ('sd', 'mass', 'error'))
+                    table['u_low'], table['h'] = float(data['u_low']), float(data['h'])
+
+        except (IOError, KeyError, ValueError):
+            table = None
+
+    if table is None:
+        table = nfw_build_table(t_range, rtol)
+
+        # Write to a temporary file first so that concurrent processes
+        # never read a partial table.
+        if file_name:
+            try:
+                temp_name = file_name + '.' + str(os.getpid())
+                with open(temp_name, 'wb') as f_handle:
+                    np.savez(f_handle, t_range = np.array(t_range, dtype = 'float64'),
+                             rtol = rtol, **table)
+                os.rename(temp_name, file_name)
+            except (IOError, OSError):
+                pass
+
+    NFW_TABLES[key] = table
+
+    return table
+
+##
+#  Function calculates the NFW profile
+#  projected surface density from the lookup
+#  table.
+#
+#  @param[in] t: t = R / r_s.
+#  @param[in] table: Optional lookup table.
+#  Default (table = nfw_table()).
+#
+def nfw_proj_sd_table(t, table = None):
+
+    if table is None:
+        table = nfw_table()
+
+    return nfw_table_interp(t, table, 'sd', nfw_proj_sd)
+
+##
+#  Function calculates the NFW profile
+#  projected mass from the lookup table.
+#
+#  @param[in] t: t = R / r_s.
+#  @param[in] table: Optional lookup table.
+#  Default (table = nfw_table()).
+#
+def nfw_proj_mass_table(t, table = None):
+
+    if table is None:
+        table = nfw_table()
+
+    return nfw_table_interp(t, table, 'mass', nfw_proj_mass)
+
+##
+#  Function calculates the difference of the
+#  NFW profile projected mass between two
+#  values of t from the lookup table.
+#
+#  @param[in] t_low: Lower value of t.
+#  @param[in] t_up: Upper value of t.
+#  @param[in] table: Optional lookup table.
+#  Default (table = nfw_table()).
+#
+def nfw_proj_mass_diff_table(t_low, t_up, table = None):
+
+    mp_low, mp_up = nfw_proj_mass_table(np.array([t_low, t_up]), table)
+
+    return mp_up - mp_low
 
 ##
 #  NFW number density for given projected
@@ -79,19 +422,20 @@ def nfw_proj_mass(t):
 #  @param[in] R_proj: Projected radius.
 #  @param[in] r_scale: Scale radius.
 #  @param[in] bg_density: Background density.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
 #
-def nfw_num_density(R_proj, r_scale, bg_density):
+def nfw_num_density(R_proj, r_scale, bg_density, R_lim = None, n_mem = None):
 
-    t_up = max(R_proj) / r_scale
-    t_low = min(R_proj) / r_scale
+    if R_lim is None:
+        R_lim = (np.min(R_proj), np.max(R_proj))
 
-    nfw_num = len(R_proj) - np.pi * r_scale ** 2 * (t_up ** 2 - t_low ** 2) * bg_density
-    nfw_den = np.pi * r_scale ** 2 * (nfw_proj_mass(t_up) - nfw_proj_mass(t_low))
+    if n_mem is None:
+        n_mem = len(R_proj)
 
-    if nfw_num <= 0:
-        nfw_num = 0.1
-    
-    return nfw_num / nfw_den
+    return proj_num_density(r_scale, bg_density, R_lim, n_mem, nfw_proj_mass_diff)
 
 ##
 #  Maximum liklihood for projected NFW
@@ -101,17 +445,58 @@ def nfw_num_density(R_proj, r_scale, bg_density):
 #  and background density.
 #  @param[in] R_proj: Projected radius.
 #  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
 #
-def nfw_proj_maxlik_bg(r_scale_bg, R_proj, weights = None):
-    
-    nfw_sd = np.array(map(nfw_proj_sd, R_proj / r_scale_bg[0]))
+def nfw_proj_maxlik_bg(r_scale_bg, R_proj, weights = None, R_lim = None, n_mem = None):
 
-    nfw_nden = nfw_num_density(R_proj, r_scale_bg[0], r_scale_bg[1])
-    
-    prob = nfw_nden * nfw_sd + r_scale_bg[1]
+    return proj_maxlik(r_scale_bg, R_proj, nfw_proj_sd, nfw_proj_mass_diff, weights,
+                       R_lim, n_mem)
 
-    if weights is None:
-        return np.sum(-np.log(prob))
+##
+#  Gradient of the maximum liklihood for
+#  projected NFW with background.
+#
+#  @param[in] r_scale_bg: Scale radius
+#  and background density.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#
+#  @return Derivatives with respect to
+#  scale radius and background density.
+#
+def nfw_proj_maxlik_bg_grad(r_scale_bg, R_proj, weights = None, R_lim = None,
+                            n_mem = None):
+
+    return proj_maxlik_derivs(r_scale_bg, R_proj, nfw_proj_sd, nfw_proj_sd_deriv,
+                              nfw_proj_mass_diff, weights, R_lim, n_mem)
+
+##
+#  Hessian of the maximum liklihood for
+#  projected NFW with background.
+#
+#  @param[in] r_scale_bg: Scale radius
+#  and background density.
+#  @param[in] R_proj: Projected radius.
+#  @param[in] weights: Optional weights.
+#  @param[in] R_lim: Optional precomputed
+#  minimum and maximum projected radius.
+#  @param[in] n_mem: Optional number of members
+#  if R_proj is binned.
+#
+#  @return 2x2 matrix of second derivatives
+#  with respect to scale radius and
+#  background density.
+#
+def nfw_proj_maxlik_bg_hess(r_scale_bg, R_proj, weights = None, R_lim = None,
+                            n_mem = None):
 
-    else:
-        return np.sum(-np.log(prob) * weights)
+    return proj_maxlik_derivs(r_scale_bg, R_proj, nfw_proj_sd, nfw_proj_sd_deriv,
+                              nfw_proj_mass_diff, weights, R_lim, n_mem,
+                              hessian = True)[1]